@@ -1,11 +1,43 @@
+import atexit
+import bisect
+import gc
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import tracemalloc
+import zlib
+from array import array
+from multiprocessing import shared_memory
+from operator import attrgetter, itemgetter
+
 import pyxel
 
+# optional, only the batch engine and the sprite compositor use it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # consts and globals
 WIDTH, HEIGHT, TILE_SIZE = 128, 128, 8
 MAP_TILES_W, MAP_TILES_H = 16, 16
 
 MAP_SRC_TILE_X = [0, 16, 16]
 MAP_SRC_TILE_Y = [0, 0, 16]
+# size of each map in tiles, each has to fit in the 256x256 tilemap from its
+# source tile, the custom map can be resized with --custom-size WxH
+MAP_SIZES = [(MAP_TILES_W, MAP_TILES_H)] * 3
+TILEMAP_TILES = 256
+
+# the menu background is drawn from this part of the tilemap
+MENU_SRC_TILE_X, MENU_SRC_TILE_Y = 0, 16
+
+# tilemap is drawn from cached chunks of CHUNK_TILES x CHUNK_TILES tiles
+CHUNK_TILES = 16
+CHUNK_PX = CHUNK_TILES * TILE_SIZE
 
 STATE_MENU = 0
 STATE_MAP_SELECT = 1
@@ -27,14 +59,15 @@ cursor_x = 0
 cursor_y = 0
 show_info = False
 
+# camera position in pixels
+cam_x = 0
+cam_y = 0
+
 boss_active = False
 boss_pending = False
 
 editor_message = ["", ""]
-editor_msg_timer = 0
-
-pyxel.init(WIDTH, HEIGHT, title="MachinesTD")
-pyxel.load("my_resource.pyxres")
+editor_msg_timer = None
 
 game_state = STATE_MENU
 pause_selection = 0
@@ -52,9 +85,7 @@ wave_timer = 0
 spawn_rounds_done = 0
 
 enemy_paths = []
-enemies = []
 towers = []
-projectiles = []
 
 boss_pending = False
 boss_active = False
@@ -73,9 +104,57 @@ AOE_SPRITES = [(7, 6), (6, 7), (7, 7)]
 DRONE_TOWER_SPRITES = [(5, 4), (4, 5), (5, 5)]
 DRONE_SPRITES = [(7, 4), (6, 5), (7, 5)]
 
+# run the simulation in a separate process (--sim-process)
+sim_process = False
+sim_link = None
+
+# draw entities with the numpy sprite compositor (--compositor)
+compositor = None
+
+# gameplay telemetry (--telemetry)
+# counters for each wave live in one row of a preallocated ring, the row is
+# appended to TELEMETRY_FILE when the wave ends
+TELEMETRY_FILE = "telemetry.bin"
+TELEMETRY_WAVES = 64
+TEL_MAX_PORTALS = 16
+TEL_DAMAGE = 0                                  # + tower kind * 3 + level - 1
+TEL_KILLS = 9                                   # + tower kind * 3 + level - 1
+TEL_LEAKS = 18                                  # + portal index
+TEL_MONEY_ENEMY = TEL_LEAKS + TEL_MAX_PORTALS   # Enemy.update reward
+TEL_MONEY_DRONE = TEL_MONEY_ENEMY + 1           # drone kill reward
+TEL_MONEY_WAVE = TEL_MONEY_ENEMY + 2            # end of wave bonus
+TEL_WASTED = TEL_MONEY_ENEMY + 3                # projectiles whose target died
+TEL_FIELDS = TEL_MONEY_ENEMY + 4
+TEL_RECORD = struct.Struct("<%di" % (TEL_FIELDS + 1))  # wave, counters
+
+telemetry_on = False
+tel_ring = array("i", bytes(4 * TEL_FIELDS * TELEMETRY_WAVES))
+tel_row = 0
+
+# allocation tracker (--alloc-track)
+# tracemalloc and gc.callbacks charge net allocations, transient peaks and gc
+# pauses to the phase of the frame that caused them. at the end of every wave
+# a line with those totals, the live objects of each class defined here and
+# the lines that grew most is appended to ALLOC_FILE
+ALLOC_FILE = "alloc.log"
+ALLOC_TREND = 5     # waves in a row a count has to grow to be flagged
+ALLOC_TOP = 3       # source lines listed per wave
+ALLOC_OTHER, ALLOC_INPUT, ALLOC_SPAWN, ALLOC_ENEMIES, ALLOC_WAVES, ALLOC_TOWERS, ALLOC_PROJECTILES, ALLOC_DRAW = range(8)
+ALLOC_PHASES = ["other", "input", "spawn", "enemies", "waves", "towers", "projectiles", "draw"]
+
+alloc_on = False
+alloc_phase_now = ALLOC_OTHER
+alloc_mark = 0                          # traced bytes when the phase started
+alloc_net = [0] * len(ALLOC_PHASES)     # per phase, reset every wave
+alloc_peak = [0] * len(ALLOC_PHASES)
+alloc_pause = [0.0] * len(ALLOC_PHASES)
+alloc_gc_runs = [0, 0, 0]
+alloc_gc_start = 0.0
+alloc_lines = {}                        # traced bytes per source line at the last wave end
+alloc_history = []                      # traced bytes and live counts per wave
+
 # custom map flags
 custom_map_exists = False
-editor_message_shown = False
 
 # editor cursor and state
 editor_selected_tile = (3, 0)
@@ -85,22 +164,117 @@ def is_grass(tile): return tile == (3, 0)
 def is_spawn(tile): return tile == (5, 0)
 def is_base(tile): return tile == (7, 0)
 
+# the sim process has no window, it reads tiles from a snapshot of the map
+# and replays the keys sent over by the window process
+tile_snapshot = None
+injected_keys = None
+
+def tile_at(x, y):
+    if tile_snapshot is not None:
+        return tile_snapshot.get((x, y), (0, 0))
+    return pyxel.tilemaps[0].pget(x, y)
+
+def snapshot_map(map_index):
+    tm = pyxel.tilemaps[0]
+    x0 = MAP_SRC_TILE_X[map_index]
+    y0 = MAP_SRC_TILE_Y[map_index]
+    map_w, map_h = MAP_SIZES[map_index]
+    return {(x, y): tm.pget(x, y) for y in range(y0, y0 + map_h) for x in range(x0, x0 + map_w)}
+
+def btnp(key):
+    if injected_keys is not None:
+        return key in injected_keys
+    return pyxel.btnp(key)
+
+# timer wheel
+# hierarchical timing wheel, level 0 has one slot per tick, each level above
+# covers WHEEL_SLOTS slots of the one below and is pulled down a slot at a time
+# when the lower level wraps, anything further out waits in overflow
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SLOTS - 1
+WHEEL_LEVELS = 3
+
+class TimerWheel:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.now = 0
+        self.levels = [[[] for _ in range(WHEEL_SLOTS)] for _ in range(WHEEL_LEVELS)]
+        self.overflow = []
+
+    def schedule(self, delay, callback):
+        # callback runs on the advance() that reaches now + delay
+        entry = [self.now + max(1, delay), callback]
+        self.insert(entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[1] = None
+
+    def remaining(self, entry):
+        return max(0, entry[0] - self.now)
+
+    def insert(self, entry):
+        due = entry[0]
+        delta = due - self.now
+        for level in range(WHEEL_LEVELS):
+            shift = WHEEL_BITS * level
+            if delta < WHEEL_SLOTS << shift:
+                self.levels[level][(due >> shift) & WHEEL_MASK].append(entry)
+                return
+        self.overflow.append(entry)
+
+    def advance(self):
+        self.now += 1
+        now = self.now
+        # cascade the levels that just wrapped
+        for level in range(1, WHEEL_LEVELS):
+            shift = WHEEL_BITS * level
+            if now & ((1 << shift) - 1):
+                break
+            slots = self.levels[level]
+            i = (now >> shift) & WHEEL_MASK
+            entries, slots[i] = slots[i], []
+            for entry in entries:
+                self.insert(entry)
+        else:
+            if not now & ((1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1):
+                entries, self.overflow = self.overflow, []
+                for entry in entries:
+                    self.insert(entry)
+        slots = self.levels[0]
+        i = now & WHEEL_MASK
+        entries, slots[i] = slots[i], []
+        for entry in entries:
+            if entry[1] is not None:
+                entry[1]()
+
+# each clock counts the ticks its old countdowns counted, tower reloads only
+# tick while the tower loop runs, spawn rounds with wave_timer, ui every frame
+tower_timers = TimerWheel()
+wave_timers = TimerWheel()
+ui_timers = TimerWheel()
+
 # tilemap helpers for custom editor region + coords
 def editor_in_area(x, y):
-    return 16 <= x < 32 and 16 <= y < 32
+    w, h = MAP_SIZES[2]
+    return (MAP_SRC_TILE_X[2] <= x < MAP_SRC_TILE_X[2] + w and
+            MAP_SRC_TILE_Y[2] <= y < MAP_SRC_TILE_Y[2] + h)
 
 # pathfinding system
 def find_paths(map_index=0):
-    tm = pyxel.tilemaps[0]
     x_offset = MAP_SRC_TILE_X[map_index]
     y_offset = MAP_SRC_TILE_Y[map_index]
+    map_w, map_h = MAP_SIZES[map_index]
     spawns = []
     goals = []
 
     # scanner
-    for y in range(y_offset, y_offset + MAP_TILES_H):
-        for x in range(x_offset, x_offset + MAP_TILES_W):
-            t = tm.pget(x, y)
+    for y in range(y_offset, y_offset + map_h):
+        for x in range(x_offset, x_offset + map_w):
+            t = tile_at(x, y)
             if is_spawn(t):
                 spawns.append((x, y))
             if is_base(t):
@@ -109,30 +283,36 @@ def find_paths(map_index=0):
     if not spawns or not goals:
         return [], [], x_offset, y_offset
 
+    def neighbours(pos):
+        x, y = pos
+        for nx, ny in [(x+1, y), (x-1, y), (x, y+1), (x, y-1)]:
+            if (x_offset <= nx < x_offset + map_w and
+                y_offset <= ny < y_offset + map_h):
+                tile = tile_at(nx, ny)
+                if is_path(tile) or is_base(tile):
+                    yield (nx, ny)
+
+    # same search order as a recursive dfs, but with an explicit stack so
+    # long paths on big maps can't hit the recursion limit
     def dfs(start, goal):
-        visited = set()
-        path = []
-
-        def _dfs(pos):
-            if pos in visited:
-                return False
-            visited.add(pos)
-            path.append(pos)
-            if pos == goal:
-                return True
-            x, y = pos
-            for nx, ny in [(x+1, y), (x-1, y), (x, y+1), (x, y-1)]:
-                if (x_offset <= nx < x_offset + MAP_TILES_W and
-                    y_offset <= ny < y_offset + MAP_TILES_H):
-                    tile = tm.pget(nx, ny)
-                    if is_path(tile) or is_base(tile):
-                        if _dfs((nx, ny)):
-                            return True
-            path.pop()
-            return False
-
-        if _dfs(start):
+        visited = {start}
+        path = [start]
+        if start == goal:
             return path
+        stack = [neighbours(start)]
+        while stack:
+            for pos in stack[-1]:
+                if pos in visited:
+                    continue
+                visited.add(pos)
+                path.append(pos)
+                if pos == goal:
+                    return path
+                stack.append(neighbours(pos))
+                break
+            else:
+                stack.pop()
+                path.pop()
         return []
 
     # build paths
@@ -146,6 +326,269 @@ def find_paths(map_index=0):
 
     return paths, spawns, x_offset, y_offset
 
+# paths only change when the custom map is edited, so they are cached per map
+path_cache = {}
+
+def get_paths(map_index):
+    if map_index not in path_cache:
+        path_cache[map_index] = find_paths(map_index)
+    return path_cache[map_index]
+
+def invalidate_map(map_index):
+    path_cache.pop(map_index, None)
+    arc_cache.clear()
+    for key in [k for k in chunk_cache if k[0] == map_index]:
+        del chunk_cache[key]
+
+# asset cache
+# the tiles of every tilemap region the game draws from and the paths of every
+# map, decoded once from RESOURCE_FILE and mapped back in on later launches.
+# the cache is only used if the resource hash, the version and the regions all
+# match, otherwise it is rebuilt
+RESOURCE_FILE = "my_resource.pyxres"
+ASSET_CACHE_FILE = "my_resource.cache"
+ASSET_CACHE_VERSION = 3  # bump when find_paths or the layout changes
+ASSET_CACHE_HEADER = struct.Struct("<4sIIII")  # magic, version, resource crc32, resource size, region count
+ASSET_CACHE_REGION = struct.Struct("<7I")      # x0, y0, w, h, tiles offset, paths offset, paths size
+# tiles: 2 bytes (u, v) per tile, row by row
+# paths: uint16 spawn count, spawns (x, y), path count, then per path its length and points
+
+def tile_regions():
+    # one per map, in map order, then the menu background, which has no paths
+    regions = [(MAP_SRC_TILE_X[m], MAP_SRC_TILE_Y[m], w, h) for m, (w, h) in enumerate(MAP_SIZES)]
+    regions.append((MENU_SRC_TILE_X, MENU_SRC_TILE_Y, WIDTH // TILE_SIZE, HEIGHT // TILE_SIZE))
+    return regions
+
+def asset_key(path=RESOURCE_FILE):
+    with open(path, "rb") as f:
+        data = f.read()
+    return zlib.crc32(data), len(data)
+
+def open_asset_cache(key):
+    try:
+        with open(ASSET_CACHE_FILE, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    regions = tile_regions()
+    ok = len(mm) >= ASSET_CACHE_HEADER.size + ASSET_CACHE_REGION.size * len(regions)
+    if ok:
+        ok = ASSET_CACHE_HEADER.unpack_from(mm, 0) == (b"MTDC", ASSET_CACHE_VERSION, key[0], key[1], len(regions))
+    for i, region in enumerate(regions):
+        if not ok:
+            break
+        entry = ASSET_CACHE_REGION.unpack_from(mm, ASSET_CACHE_HEADER.size + i * ASSET_CACHE_REGION.size)
+        ok = entry[:4] == region and entry[5] + entry[6] <= len(mm)
+    if not ok:
+        mm.close()
+        return None
+    return mm
+
+def write_asset_cache(key):
+    # right after a full pyxel.load, the tilemap is the shipped one with a
+    # resized custom map filled in
+    tm = pyxel.tilemaps[0]
+    regions = tile_regions()
+    entries = []
+    blobs = []
+    offset = ASSET_CACHE_HEADER.size + ASSET_CACHE_REGION.size * len(regions)
+    for i, (x0, y0, w, h) in enumerate(regions):
+        tiles = bytes(v for y in range(y0, y0 + h) for x in range(x0, x0 + w) for v in tm.pget(x, y))
+        data = b""
+        if i < len(MAP_SIZES):
+            paths, spawns, _, _ = get_paths(i)
+            data = array("H", [len(spawns)])
+            for sp in spawns:
+                data.extend(sp)
+            data.append(len(paths))
+            for path in paths:
+                data.append(len(path))
+                for pt in path:
+                    data.extend(pt)
+            data = data.tobytes()
+        entries.append((x0, y0, w, h, offset, offset + len(tiles), len(data)))
+        blobs += [tiles, data]
+        offset += len(tiles) + len(data)
+    tmp = ASSET_CACHE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(ASSET_CACHE_HEADER.pack(b"MTDC", ASSET_CACHE_VERSION, key[0], key[1], len(regions)))
+        for entry in entries:
+            f.write(ASSET_CACHE_REGION.pack(*entry))
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp, ASSET_CACHE_FILE)
+
+def use_asset_cache(mm, tilemap=True):
+    # seeds path_cache, and the pyxel tilemap or, without a window, tile_snapshot
+    global tile_snapshot
+    snapshot = {}
+    for m in range(len(tile_regions())):
+        x0, y0, w, h, tiles_off, paths_off, paths_size = ASSET_CACHE_REGION.unpack_from(
+            mm, ASSET_CACHE_HEADER.size + m * ASSET_CACHE_REGION.size)
+        tiles = mm[tiles_off:tiles_off + w * h * 2]
+        for i in range(w * h):
+            pos = (x0 + i % w, y0 + i // w)
+            tile = (tiles[2 * i], tiles[2 * i + 1])
+            if tilemap:
+                pyxel.tilemaps[0].pset(pos[0], pos[1], tile)
+            else:
+                snapshot[pos] = tile
+        if m >= len(MAP_SIZES):
+            continue
+        data = array("H")
+        data.frombytes(mm[paths_off:paths_off + paths_size])
+        n = data[0]
+        spawns = [(data[1 + 2 * i], data[2 + 2 * i]) for i in range(n)]
+        i = 1 + 2 * n
+        paths = []
+        for _ in range(data[i]):
+            length = data[i + 1]
+            pts = data[i + 2:i + 2 + 2 * length]
+            paths.append([(pts[j], pts[j + 1]) for j in range(0, len(pts), 2)])
+            i += 1 + 2 * length
+        path_cache[m] = (paths, spawns, x0, y0)
+    if not tilemap:
+        tile_snapshot = snapshot
+
+# chunked tilemap rendering with camera
+chunk_cache = {}
+
+def map_chunk(map_index, cx, cy):
+    key = (map_index, cx, cy)
+    chunk = chunk_cache.get(key)
+    if chunk is None:
+        map_w, map_h = MAP_SIZES[map_index]
+        w = min(CHUNK_TILES, map_w - cx * CHUNK_TILES) * TILE_SIZE
+        h = min(CHUNK_TILES, map_h - cy * CHUNK_TILES) * TILE_SIZE
+        img = pyxel.Image(CHUNK_PX, CHUNK_PX)
+        img.bltm(0, 0, 0, (MAP_SRC_TILE_X[map_index] + cx * CHUNK_TILES) * TILE_SIZE,
+                 (MAP_SRC_TILE_Y[map_index] + cy * CHUNK_TILES) * TILE_SIZE, w, h)
+        chunk = chunk_cache[key] = (img, w, h)
+    return chunk
+
+def draw_tilemap(map_index):
+    # world space, call with the camera set
+    map_w, map_h = MAP_SIZES[map_index]
+    cx1 = min((cam_x + WIDTH - 1) // CHUNK_PX, (map_w - 1) // CHUNK_TILES)
+    cy1 = min((cam_y + HEIGHT - 1) // CHUNK_PX, (map_h - 1) // CHUNK_TILES)
+    for cy in range(cam_y // CHUNK_PX, cy1 + 1):
+        for cx in range(cam_x // CHUNK_PX, cx1 + 1):
+            img, w, h = map_chunk(map_index, cx, cy)
+            pyxel.blt(cx * CHUNK_PX, cy * CHUNK_PX, img, 0, 0, w, h)
+
+def follow_cursor(map_index):
+    global cam_x, cam_y
+    map_w, map_h = MAP_SIZES[map_index]
+    cam_x = max(0, min(map_w * TILE_SIZE - WIDTH, cursor_x * TILE_SIZE + TILE_SIZE // 2 - WIDTH // 2))
+    cam_y = max(0, min(map_h * TILE_SIZE - HEIGHT, cursor_y * TILE_SIZE + TILE_SIZE // 2 - HEIGHT // 2))
+
+def enter_map(map_index):
+    # the cursor may still sit where it was on a bigger map
+    global cursor_x, cursor_y
+    map_w, map_h = MAP_SIZES[map_index]
+    cursor_x = max(0, min(map_w - 1, cursor_x))
+    cursor_y = max(0, min(map_h - 1, cursor_y))
+    follow_cursor(map_index)
+
+def resize_custom_map(w, h):
+    # before the asset cache is opened, the region has to fit in the tilemap
+    MAP_SIZES[2] = (max(1, min(w, TILEMAP_TILES - MAP_SRC_TILE_X[2])),
+                    max(1, min(h, TILEMAP_TILES - MAP_SRC_TILE_Y[2])))
+
+def fill_custom_map():
+    # tiles of a resized custom map outside the shipped one start out as grass
+    tm = pyxel.tilemaps[0]
+    x0, y0 = MAP_SRC_TILE_X[2], MAP_SRC_TILE_Y[2]
+    map_w, map_h = MAP_SIZES[2]
+    for y in range(y0, y0 + map_h):
+        for x in range(x0, x0 + map_w):
+            if tm.pget(x, y) == (0, 0):
+                tm.pset(x, y, (3, 0))
+    invalidate_map(2)
+
+def in_view(px, py):
+    # px, py is the top left of an 8x8 sprite in world pixels
+    return (cam_x - TILE_SIZE < px < cam_x + WIDTH and
+            cam_y - TILE_SIZE < py < cam_y + HEIGHT)
+
+# entity arenas
+# enemies and projectiles sit in slots that are reused through a free list, a
+# handle is (slot, generation). killing an entity bumps the generation of its
+# slot so old handles stop resolving at once, compact() then swaps the dead out
+# of items, which is the enemies or projectiles list, and frees their slots
+ENEMY_SLOTS = 256
+PROJECTILE_SLOTS = 256
+
+class Arena:
+    def __init__(self, capacity):
+        self.items = []  # live entities, in no particular order
+        self.slots = [None] * capacity
+        self.gens = [0] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+        self.dead = []
+        self.seq = 0
+        self.cleared = 0
+
+    def add(self, item):
+        if not self.free:
+            # out of slots, double them
+            n = len(self.slots)
+            self.slots.extend([None] * n)
+            self.gens.extend([0] * n)
+            self.free = list(range(2 * n - 1, n - 1, -1))
+        slot = self.free.pop()
+        self.slots[slot] = item
+        # add order, the old list order, for ties and traces
+        self.seq += 1
+        item.seq = self.seq
+        item.handle = (slot, self.gens[slot])
+        item.pos = len(self.items)
+        item.alive = True
+        self.items.append(item)
+        return item
+
+    def get(self, handle):
+        slot, gen = handle
+        if self.gens[slot] == gen:
+            return self.slots[slot]
+        return None
+
+    def kill(self, item):
+        if item.alive:
+            item.alive = False
+            self.gens[item.handle[0]] += 1
+            self.dead.append(item)
+
+    def compact(self):
+        items = self.items
+        for item in self.dead:
+            last = items.pop()
+            if last is not item:
+                items[item.pos] = last
+                last.pos = item.pos
+            slot = item.handle[0]
+            self.slots[slot] = None
+            self.free.append(slot)
+        self.dead.clear()
+
+    def clear(self):
+        self.take()
+        # a batch engine holding rows for this arena drops them
+        self.cleared += 1
+
+    def take(self):
+        # empties the arena and returns what was in it
+        items = list(self.items)
+        for item in items:
+            self.kill(item)
+        self.compact()
+        return items
+
+enemy_arena = Arena(ENEMY_SLOTS)
+projectile_arena = Arena(PROJECTILE_SLOTS)
+enemies = enemy_arena.items
+projectiles = projectile_arena.items
+
 # enemies
 class Enemy:
     def __init__(self, path, speed_tiles=DEFAULT_SPEED_TILES, hp=5, reward=5, sprite=(5,2)):
@@ -160,19 +603,26 @@ class Enemy:
         self.reward = reward
         self.sprite = sprite
         self.rewarded = False
+        self.portal = 0
+        # false while walking from a portal to the start of a path it doesn't begin at
+        self.on_path = True
 
     def update(self):
         global base_hp, money
         if self.hp <= 0:
-            self.alive = False
+            enemy_arena.kill(self)
             if not self.rewarded:
                 money += self.reward
                 self.rewarded = True
+                if telemetry_on:
+                    tel_ring[tel_row + TEL_MONEY_ENEMY] += self.reward
             return
 
         if self.index >= len(self.path) - 1:
-            self.alive = False
+            enemy_arena.kill(self)
             base_hp -= 1
+            if telemetry_on:
+                tel_ring[tel_row + TEL_LEAKS + min(self.portal, TEL_MAX_PORTALS - 1)] += 1
             return
 
         nx, ny = self.path[self.index + 1]
@@ -204,21 +654,31 @@ class BossEnemy(Enemy):
 
 # projectiles
 class Projectile:
-    def __init__(self, x, y, target, damage, speed=2.5, aoe_radius=0):
+    def __init__(self, x, y, target, damage, speed=2.5, aoe_radius=0, source=None, point=None):
+        # flies at an enemy, held by its handle, or at a fixed point
         self.x = x
         self.y = y
-        self.target = target
+        self.target = target.handle if target is not None else None
+        self.point = point
         self.damage = damage
         self.speed = speed
         self.aoe_radius = aoe_radius
         self.alive = True
+        self.source = source
 
     def update(self):
-        if not self.target.alive:
-            self.alive = False
-            return
-        tx = self.target.px + TILE_SIZE/2
-        ty = self.target.py + TILE_SIZE/2
+        if self.target is None:
+            target = None
+            tx, ty = self.point
+        else:
+            target = enemy_arena.get(self.target)
+            if target is None:
+                projectile_arena.kill(self)
+                if telemetry_on:
+                    tel_ring[tel_row + TEL_WASTED] += 1
+                return
+            tx = target.px + TILE_SIZE/2
+            ty = target.py + TILE_SIZE/2
         dx = tx - self.x
         dy = ty - self.y
         dist = (dx*dx + dy*dy) ** 0.5
@@ -230,9 +690,13 @@ class Projectile:
                     ey = e.py + TILE_SIZE/2
                     if (ex - tx)**2 + (ey - ty)**2 <= self.aoe_radius**2:
                         e.hp -= self.damage
+                        if telemetry_on:
+                            record_hit(self.source, e, self.damage)
             else:
-                self.target.hp -= self.damage
-            self.alive = False
+                target.hp -= self.damage
+                if telemetry_on:
+                    record_hit(self.source, target, self.damage)
+            projectile_arena.kill(self)
             return
         if dist != 0:
             self.x += (dx/dist) * self.speed
@@ -250,11 +714,42 @@ class Drone:
         self.y = tower.ty * TILE_SIZE + TILE_SIZE//2
         self.speed = 1.6
         self.reload = 20
-        self.timer = 0
+        # the reload runs on the tower's timers while chasing, anything left of
+        # it waits in reload_left while the drone isn't chasing
+        self.reload_entry = None
+        self.reload_left = 0
+        self.reloaded_at = -1
         self.target = None
 
+    @property
+    def timer(self):
+        # ticks left until the drone can hit again
+        if self.reload_entry:
+            return self.tower.timers.remaining(self.reload_entry)
+        return self.reload_left
+
+    def reloaded(self):
+        self.reload_entry = None
+        self.reloaded_at = self.tower.timers.now
+
+    def hold_reload(self):
+        # a tick without chasing doesn't count towards the reload
+        timers = self.tower.timers
+        if self.reload_entry:
+            self.reload_left = timers.remaining(self.reload_entry) + 1
+            timers.cancel(self.reload_entry)
+            self.reload_entry = None
+        elif self.reloaded_at == timers.now:
+            self.reload_left = 1
+
+    def resume_reload(self):
+        # this chasing tick is the first of what was left
+        if self.reload_left > 1:
+            self.reload_entry = self.tower.timers.schedule(self.reload_left - 1, self.reloaded)
+        self.reload_left = 0
+
     def update(self):
-        # pick nearest target
+        # pick nearest target, the earliest spawned one on a tie
         best = None
         bestd = 1e9 # start with a big number, so any distance between the drone and the enemy will be lower (hard to understand)
         for e in enemies:
@@ -262,22 +757,43 @@ class Drone:
             dx = (e.px + TILE_SIZE/2) - self.x
             dy = (e.py + TILE_SIZE/2) - self.y
             d = dx*dx + dy*dy
-            if d < bestd:
+            if d < bestd or (d == bestd and e.seq < best.seq):
                 bestd = d; best = e
-        self.target = best
-        if not self.target:
-            # return to tower
-            tx = self.tower.tx * TILE_SIZE + TILE_SIZE//2
-            ty = self.tower.ty * TILE_SIZE + TILE_SIZE//2
-            dx = tx - self.x; dy = ty - self.y
-            dist = (dx*dx + dy*dy)**0.5
-            if dist > 0:
-                step = min(self.speed, dist)
-                self.x += (dx/dist) * step
-                self.y += (dy/dist) * step
+        target = best
+        self.target = target.handle if target else None
+        if not target:
+            self.idle()
             return
-        tx = self.target.px + TILE_SIZE/2
-        ty = self.target.py + TILE_SIZE/2
+        if self.chase(target.px + TILE_SIZE/2, target.py + TILE_SIZE/2):
+            target.hp -= self.tower.drone_damage
+            if telemetry_on:
+                record_hit(self.tower, target, self.tower.drone_damage)
+            if target.hp <= 0 and not target.rewarded:
+                enemy_arena.kill(target)
+                target.rewarded = True
+                global money
+                money += target.reward
+                if telemetry_on:
+                    tel_ring[tel_row + TEL_MONEY_DRONE] += target.reward
+
+    def idle(self):
+        self.hold_reload()
+        # return to tower
+        tx = self.tower.tx * TILE_SIZE + TILE_SIZE//2
+        ty = self.tower.ty * TILE_SIZE + TILE_SIZE//2
+        dx = tx - self.x; dy = ty - self.y
+        dist = (dx*dx + dy*dy)**0.5
+        if dist > 0:
+            step = min(self.speed, dist)
+            self.x += (dx/dist) * step
+            self.y += (dy/dist) * step
+        else:
+            # parked with nothing alive, sleep until the next spawn
+            self.tower.park()
+
+    def chase(self, tx, ty):
+        # flies at tx, ty, true when the target is in reach and the drone
+        # reloaded, the next reload starts then
         dx = tx - self.x; dy = ty - self.y
         dist = (dx*dx + dy*dy)**0.5
         if dist > 0:
@@ -286,15 +802,12 @@ class Drone:
                 self.x = tx; self.y = ty
             else:
                 self.x += dx/dist * step; self.y += dy/dist * step
-        self.timer = max(0, self.timer - 1)
-        if self.timer == 0 and dist < 20:
-            self.target.hp -= self.tower.drone_damage
-            if self.target.hp <= 0 and not self.target.rewarded:
-                self.target.alive = False
-                self.target.rewarded = True
-                global money
-                money += self.target.reward
-            self.timer = self.reload
+        if self.reload_left:
+            self.resume_reload()
+        if self.reload_entry is None and dist < 20:
+            self.reload_entry = self.tower.timers.schedule(self.reload, self.reloaded)
+            return True
+        return False
 
     def draw(self):
         lvl = max(1, min(3, self.tower.level))
@@ -305,9 +818,76 @@ class Drone:
 
 # towers
 class BaseTower:
+    kind = 0
+
     def __init__(self, tx, ty, map_index):
         self.tx = tx; self.ty = ty; self.map_index = map_index
         self.level = 1
+        # towers only run while awake, a reload puts them to sleep on tower_timers
+        # and having no enemies to shoot parks them until the next spawn
+        self.order = 0
+        self.timers = tower_timers  # of the game it is built in
+        self.awake = False
+        self.wake_entry = None
+        self.parked = False
+        # path coverage for targeting, rebuilt when range or paths change
+        self.covered = None
+        self.covered_paths = None
+
+    @property
+    def timer(self):
+        # ticks left until the tower can fire again
+        return self.timers.remaining(self.wake_entry) if self.wake_entry else 0
+
+    def sleep(self, ticks):
+        self.awake = False
+        self.wake_entry = self.timers.schedule(ticks, self.wake)
+
+    def wake(self):
+        self.wake_entry = None
+        self.parked = False
+        wake_tower(self)
+
+    def park(self):
+        self.awake = False
+        self.parked = True
+
+    def covered_spans(self):
+        paths = get_paths(self.map_index)[0]
+        if self.covered is None or self.covered_paths is not paths:
+            cx = self.center_px(); cy = self.center_py()
+            self.covered = {id(p): path_coverage(p, cx, cy, self.range + COVER_PAD) for p in paths}
+            self.covered_paths = paths
+        return self.covered
+
+    def find_target(self):
+        # first enemy in enemies order within range, looked up in the progress
+        # index instead of scanning everything, candidates are checked exactly
+        global target_index
+        if target_index is None:
+            target_index = build_target_index()
+        groups, strays = target_index
+        covered = self.covered_spans()
+        candidates = list(strays)
+        for key, (progress, group) in groups.items():
+            spans = covered.get(key)
+            if spans is None:
+                candidates.extend(group)
+                continue
+            for s0, s1 in spans:
+                candidates.extend(group[bisect.bisect_left(progress, s0):bisect.bisect_right(progress, s1)])
+
+        cx = self.center_px(); cy = self.center_py()
+        r2 = self.range*self.range
+        best = None
+        for e in candidates:
+            if best is not None and e.seq >= best.seq:
+                continue
+            dx = (e.px + TILE_SIZE/2) - cx
+            dy = (e.py + TILE_SIZE/2) - cy
+            if dx*dx + dy*dy <= r2:
+                best = e
+        return best
 
     def upgrade(self):
         global money
@@ -317,6 +897,7 @@ class BaseTower:
             money -= cost
             self.level += 1
             self.on_upgrade()
+            self.covered = None
 
     def on_upgrade(self):
         pass
@@ -341,7 +922,6 @@ class NormalTower(BaseTower):
         self.range = 30
         self.damage = 1
         self.reload = 30
-        self.timer = 0
 
     def on_upgrade(self):
         self.damage += 1
@@ -349,15 +929,14 @@ class NormalTower(BaseTower):
         self.reload = max(10, self.reload - 3)
 
     def update(self, enemies_list, projectiles_list):
-        self.timer = max(0, self.timer - 1)
-        if self.timer == 0:
-            for e in enemies_list:
-                dx = (e.px + TILE_SIZE/2) - self.center_px()
-                dy = (e.py + TILE_SIZE/2) - self.center_py()
-                if dx*dx + dy*dy <= self.range*self.range:
-                    projectiles_list.append(Projectile(self.center_px(), self.center_py(), e, self.damage))
-                    self.timer = self.reload
-                    break
+        if not enemies:
+            # nothing to shoot at, sleep until the next spawn
+            self.park()
+            return
+        e = self.find_target()
+        if e is not None:
+            projectile_arena.add(Projectile(self.center_px(), self.center_py(), e, self.damage, source=self))
+            self.sleep(self.reload)
 
     def draw(self):
         sx, sy = NORMAL_SPRITES[max(0, min(2, self.level-1))]
@@ -370,14 +949,18 @@ class NormalTower(BaseTower):
     def get_ui_range(self):
         return self.range
 
+# spread projectiles cuz the tower is AOE
+AOE_OFFSETS = [(-8, -4), (-4, -2), (0, 0), (4, 2), (8, 4)]
+
 class AOETower(BaseTower):
+    kind = 1
+
     def __init__(self, tx, ty, map_index):
         super().__init__(tx, ty, map_index)
         self.range = 20
         self.splash = 12
         self.damage = 2
         self.reload = 45
-        self.timer = 0
         self.projectile_count = 3
 
     def on_upgrade(self):
@@ -388,27 +971,20 @@ class AOETower(BaseTower):
         self.projectile_count = min(5, self.projectile_count + 1)
 
     def update(self, enemies_list, projectiles_list):
-        self.timer = max(0, self.timer - 1)
-        if self.timer == 0:
-            for e in enemies_list:
-                dx = (e.px + TILE_SIZE / 2) - self.center_px()
-                dy = (e.py + TILE_SIZE / 2) - self.center_py()
-                if dx * dx + dy * dy <= self.range * self.range:
-                    n = self.projectile_count
-                    # spread projectiles cuz the tower is AOE
-                    offsets = [(-8, -4), (-4, -2), (0, 0), (4, 2), (8, 4)]
-                    # center around the enemy position
-                    for i in range(n):
-                        ox, oy = offsets[i]
-                        dummy = type("T", (), {})() # creating generic object, this makes the projectile spread and not go all for the same enemy
-                        # !!!!!! GLITCHING MONEY !!!!!!
-                        dummy.px = e.px + ox
-                        dummy.py = e.py + oy
-                        dummy.alive = True
-                        dummy.hp = 9999
-                        projectiles_list.append(Projectile(self.center_px(), self.center_py(), dummy, self.damage, speed=2.5, aoe_radius=self.splash))
-                    self.timer = self.reload
-                    break
+        if not enemies:
+            self.park()
+            return
+        e = self.find_target()
+        if e is not None:
+            n = self.projectile_count
+            # center around the enemy position, each projectile flies at its own
+            # point so they spread and don't all go for the same enemy
+            for i in range(n):
+                ox, oy = AOE_OFFSETS[i]
+                point = (e.px + ox + TILE_SIZE/2, e.py + oy + TILE_SIZE/2)
+                projectile_arena.add(Projectile(self.center_px(), self.center_py(), None, self.damage, speed=2.5,
+                                                aoe_radius=self.splash, source=self, point=point))
+            self.sleep(self.reload)
 
     def draw(self):
         sx, sy = AOE_SPRITES[max(0, min(2, self.level - 1))]
@@ -421,6 +997,8 @@ class AOETower(BaseTower):
         return self.range
 
 class DroneTower(BaseTower):
+    kind = 2
+
     def __init__(self, tx, ty, map_index):
         super().__init__(tx, ty, map_index)
         self.drone = Drone(self)
@@ -444,13 +1022,201 @@ class DroneTower(BaseTower):
     def get_ui_range(self):
         return 25
 
+TOWER_CLASSES = [NormalTower, AOETower, DroneTower]
+
+# tower targeting
+# towers and paths don't move, so each tower keeps the arc length intervals of
+# every path inside its range, and enemies are indexed by how far along their
+# path they are, a tower only looks at the enemies inside its intervals
+COVER_PAD = 1.0  # px of slack, the exact distance check has the final say
+
+arc_cache = {}
+target_index = None  # built on the first lookup of each tower loop
+batch_live = (0, 0)  # see wave_checks
+
+def path_arcs(path):
+    # arc length in px at each point of path
+    entry = arc_cache.get(id(path))
+    if entry is None or entry[0] is not path:
+        cum = [0.0]
+        for (x0, y0), (x1, y1) in zip(path, path[1:]):
+            dx = (x1 - x0) * TILE_SIZE; dy = (y1 - y0) * TILE_SIZE
+            cum.append(cum[-1] + (dx*dx + dy*dy) ** 0.5)
+        entry = arc_cache[id(path)] = (path, cum)
+    return entry[1]
+
+def path_coverage(path, cx, cy, r):
+    # merged [s0, s1] intervals where an enemy on path is within r of cx, cy
+    cum = path_arcs(path)
+    half = TILE_SIZE / 2
+    spans = []
+    for i in range(len(path) - 1):
+        ax = path[i][0] * TILE_SIZE + half - cx
+        ay = path[i][1] * TILE_SIZE + half - cy
+        dx = (path[i+1][0] - path[i][0]) * TILE_SIZE
+        dy = (path[i+1][1] - path[i][1]) * TILE_SIZE
+        # |a + t*d| <= r for t in [0, 1]
+        a = dx*dx + dy*dy
+        b = 2 * (ax*dx + ay*dy)
+        c = ax*ax + ay*ay - r*r
+        if a == 0:
+            if c > 0:
+                continue
+            t0, t1 = 0.0, 0.0
+        else:
+            disc = b*b - 4*a*c
+            if disc < 0:
+                continue
+            root = disc ** 0.5
+            t0 = max(0.0, (-b - root) / (2*a))
+            t1 = min(1.0, (-b + root) / (2*a))
+            if t0 > t1:
+                continue
+        seg = cum[i+1] - cum[i]
+        s0 = cum[i] + t0 * seg - COVER_PAD
+        s1 = cum[i] + t1 * seg + COVER_PAD
+        if spans and s0 <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], s1)
+        else:
+            spans.append([s0, s1])
+    return spans
+
+def build_target_index():
+    # enemies per path sorted by progress, enemies still walking in from a
+    # portal off their path are checked by every tower
+    groups = {}
+    strays = []
+    for e in enemies:
+        if e.index == 0 and not e.on_path:
+            strays.append(e)
+            continue
+        i = min(e.index, len(e.path) - 1)
+        x, y = e.path[i]
+        dx = e.px - x * TILE_SIZE; dy = e.py - y * TILE_SIZE
+        groups.setdefault(id(e.path), []).append((path_arcs(e.path)[i] + (dx*dx + dy*dy) ** 0.5, e.seq, e))
+    index = {}
+    for key, group in groups.items():
+        group.sort()
+        index[key] = ([g[0] for g in group], [g[2] for g in group])
+    return index, strays
+
+# wave end hook, telemetry and the allocation tracker each write their record
+def end_wave_reports():
+    if telemetry_on:
+        flush_telemetry()
+    if alloc_on:
+        report_alloc()
+
+# telemetry helpers, only called when telemetry_on
+def record_hit(tower, e, damage):
+    if tower is None:
+        return
+    slot = tel_row + tower.kind * 3 + max(1, min(3, tower.level)) - 1
+    tel_ring[slot + TEL_DAMAGE] += damage
+    if e.hp <= 0 < e.hp + damage:
+        tel_ring[slot + TEL_KILLS] += 1
+
+def flush_telemetry():
+    global tel_row
+    row = tel_ring[tel_row:tel_row + TEL_FIELDS]
+    with open(TELEMETRY_FILE, "ab") as f:
+        f.write(TEL_RECORD.pack(wave, *row))
+    tel_row = (tel_row + TEL_FIELDS) % len(tel_ring)
+    clear_telemetry_row()
+
+def clear_telemetry_row():
+    tel_ring[tel_row:tel_row + TEL_FIELDS] = array("i", bytes(4 * TEL_FIELDS))
+
+def read_telemetry(path=TELEMETRY_FILE):
+    with open(path, "rb") as f:
+        data = f.read()
+    return [(r[0], r[1:]) for r in TEL_RECORD.iter_unpack(data[:len(data) - len(data) % TEL_RECORD.size])]
+
+# allocation tracker helpers, only called when alloc_on
+def start_alloc_track():
+    global alloc_on, alloc_mark, alloc_lines
+    alloc_on = True
+    tracemalloc.start()
+    gc.callbacks.append(alloc_gc_callback)
+    alloc_lines = traced_lines()
+    alloc_mark = tracemalloc.get_traced_memory()[0]
+
+def alloc_phase(phase):
+    global alloc_phase_now, alloc_mark
+    current, peak = tracemalloc.get_traced_memory()
+    p = alloc_phase_now
+    alloc_net[p] += current - alloc_mark
+    alloc_peak[p] = max(alloc_peak[p], peak - alloc_mark)
+    tracemalloc.reset_peak()
+    alloc_phase_now = phase
+    alloc_mark = current
+
+def alloc_gc_callback(phase, info):
+    global alloc_gc_start
+    if phase == "start":
+        alloc_gc_start = time.perf_counter()
+    else:
+        alloc_pause[alloc_phase_now] += time.perf_counter() - alloc_gc_start
+        alloc_gc_runs[info["generation"]] += 1
+
+def traced_lines():
+    # without tracemalloc's own frames, and only the sizes are kept so no
+    # snapshot outlives the call
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    return {(s.traceback[0].filename, s.traceback[0].lineno): s.size for s in snapshot.statistics("lineno")}
+
+def live_objects():
+    # instances of the classes of this module
+    counts = {}
+    for o in gc.get_objects():
+        cls = type(o)
+        if cls.__module__ == __name__:
+            counts[cls.__name__] = counts.get(cls.__name__, 0) + 1
+    return counts
+
+def growing(history, key):
+    values = [h.get(key, 0) for h in history[-ALLOC_TREND - 1:]]
+    return len(values) > ALLOC_TREND and all(a < b for a, b in zip(values, values[1:]))
+
+def report_alloc():
+    global alloc_lines, alloc_mark
+    alloc_phase(alloc_phase_now)
+    counts = live_objects()
+    counts["traced"] = tracemalloc.get_traced_memory()[0]
+    alloc_history.append(counts)
+    lines = traced_lines()
+    diffs = sorted(((size - alloc_lines.get(line, 0), line) for line, size in lines.items()), reverse=True)
+    top = [(line, diff) for diff, line in diffs[:ALLOC_TOP] if diff > 0]
+    alloc_lines = lines
+    parts = ["wave %d traced %dk gc %d/%d/%d" % (wave, counts["traced"] // 1024, *alloc_gc_runs)]
+    for i, name in enumerate(ALLOC_PHASES):
+        if alloc_net[i] or alloc_peak[i] or alloc_pause[i]:
+            parts.append("%s %+dk peak %dk pause %.1fms" % (name, alloc_net[i] // 1024, alloc_peak[i] // 1024, alloc_pause[i] * 1000))
+    parts.append("live " + " ".join("%s %d" % (k, v) for k, v in sorted(counts.items()) if k != "traced"))
+    parts.append("top " + " ".join("%s:%d %+dk" % (os.path.basename(name), lineno, diff // 1024) for (name, lineno), diff in top))
+    flagged = [k for k in sorted(counts) if growing(alloc_history, k)]
+    if flagged:
+        parts.append("growing " + " ".join(flagged))
+    with open(ALLOC_FILE, "a") as f:
+        f.write(" | ".join(parts) + "\n")
+    for i in range(len(ALLOC_PHASES)):
+        alloc_net[i] = alloc_peak[i] = 0
+        alloc_pause[i] = 0.0
+    alloc_gc_runs[:] = [0, 0, 0]
+    # the report's own allocations aren't charged to the next phase
+    alloc_mark = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+
 # game control
 def start_wave():
     global wave_active, wave_timer, enemies, spawn_rounds_done, boss_pending, boss_active
     wave_active = True
     wave_timer = 0
-    enemies.clear()
+    enemy_arena.clear()
     spawn_rounds_done = 0
+    wave_timers.clear()
+    for r in range(1, SPAWN_ROUNDS_PER_WAVE + 1):
+        wave_timers.schedule(r * SPAWN_INTERVAL_FRAMES, spawn_round)
     boss_active = False
     boss_pending = (wave % 10 == 0)
 
@@ -460,9 +1226,9 @@ def reset_game():
     wave = 1
     wave_active = False
     wave_timer = 0
-    enemies.clear()
-    towers.clear()
-    projectiles.clear()
+    enemy_arena.clear()
+    clear_towers()
+    projectile_arena.clear()
     money = 50
     base_hp = BASE_HP
     infinite_mode = False
@@ -472,9 +1238,9 @@ def safe_return_to_menu():
     global wave_timer, spawn_rounds_done, boss_active, boss_pending, infinite_mode, cursor_x, cursor_y
 
     # clear active entities
-    enemies.clear()
-    towers.clear()
-    projectiles.clear()
+    enemy_arena.clear()
+    clear_towers()
+    projectile_arena.clear()
 
     # reset state
     base_hp = BASE_HP
@@ -487,12 +1253,101 @@ def safe_return_to_menu():
     boss_pending = False
     infinite_mode = False
 
+    # the abandoned wave is never flushed, its counters don't carry over
+    clear_telemetry_row()
+
     cursor_x = 0
     cursor_y = 0
+    follow_cursor(map_selection)
 
     # back to menu
     game_state = STATE_MENU
 
+# tower lookup by tile, kept in sync with towers
+tower_index = {}
+
+def tower_at(tx, ty, map_index=None):
+    if map_index is None:
+        map_index = map_selection
+    return tower_index.get((map_index, tx, ty))
+
+# towers that need an update this tick, in build order like towers
+awake_towers = []
+tower_seq = 0
+
+def wake_tower(t):
+    t.awake = True
+    bisect.insort(awake_towers, t, key=lambda tw: tw.order)
+
+def wake_parked():
+    for t in towers:
+        if t.parked:
+            t.wake()
+
+def add_tower(t):
+    global tower_seq
+    tower_seq += 1
+    t.order = tower_seq
+    towers.append(t)
+    tower_index[(t.map_index, t.tx, t.ty)] = t
+    wake_tower(t)
+
+def remove_tower(t):
+    towers.remove(t)
+    tower_index.pop((t.map_index, t.tx, t.ty), None)
+    if t.wake_entry:
+        tower_timers.cancel(t.wake_entry)
+    if isinstance(t, DroneTower) and t.drone and t.drone.reload_entry:
+        tower_timers.cancel(t.drone.reload_entry)
+    if t.awake:
+        awake_towers.remove(t)
+
+def clear_towers():
+    towers.clear()
+    tower_index.clear()
+    awake_towers.clear()
+    tower_timers.clear()
+
+# retained ui
+# widgets keep their text rendered in a small image and only redraw it
+# when the value they are bound to changes
+class UIText:
+    def __init__(self, x, y, w, h, bind, fmt, line_h=10):
+        self.x = x; self.y = y; self.w = w; self.h = h
+        self.bind = bind
+        self.fmt = fmt
+        self.line_h = line_h
+        self.value = None
+        self.image = None
+
+    def draw(self):
+        value = self.bind()
+        if value is None:
+            return
+        if self.image is None:
+            self.image = pyxel.Image(self.w, self.h)
+            self.value = None
+        if value != self.value:
+            self.value = value
+            self.image.cls(0)
+            for i, (text, col) in enumerate(self.fmt(value)):
+                self.image.text(0, i * self.line_h, text, col)
+        pyxel.blt(self.x, self.y, self.image, 0, 0, self.w, self.h, 0)
+
+# static screens are composited once and then blitted every frame
+cached_screens = {}
+
+def cached_screen(key, build):
+    img = cached_screens.get(key)
+    if img is None:
+        img = pyxel.Image(WIDTH, HEIGHT)
+        img.cls(0)
+        build(img)
+        cached_screens[key] = img
+    return img
+
+def blit_screen(img, colkey=None):
+    pyxel.blt(0, 0, img, 0, 0, WIDTH, HEIGHT, colkey)
 
 # menu
 def update_menu():
@@ -500,85 +1355,67 @@ def update_menu():
     if pyxel.btnp(pyxel.KEY_RETURN):
         game_state = STATE_MAP_SELECT
 
-def draw_menu():
-    pyxel.cls(0)
-    pyxel.bltm(0, 0, 0, 0, 16 * 8, 128, 128)
+def build_menu(img):
+    img.bltm(0, 0, 0, MENU_SRC_TILE_X * TILE_SIZE, MENU_SRC_TILE_Y * TILE_SIZE, WIDTH, HEIGHT)
 
-    pyxel.text(20, 15, "MACHINES TOWER DEFENSE", 10)
-    pyxel.text(25, 30, "Press ENTER to Start", 7 if (pyxel.frame_count // 30) % 2 == 0 else 1)
+    img.text(20, 15, "MACHINES TOWER DEFENSE", 10)
 
-    pyxel.text(10, 50, "CONTROLS:", 11)
-    pyxel.text(10, 60, "Arrows: Move Cursor", 7)
-    pyxel.text(10, 70, "1/2/3: Select Tower", 7)
-    pyxel.text(10, 80, "Space: Build", 7)
-    pyxel.text(10, 90, "U: Upgrade | Backspace: Sell", 7)
-    pyxel.text(10, 100, "P: Pause", 7)
-    pyxel.text(10, 110, "I: Tower Info", 7)
+    img.text(10, 50, "CONTROLS:", 11)
+    img.text(10, 60, "Arrows: Move Cursor", 7)
+    img.text(10, 70, "1/2/3: Select Tower", 7)
+    img.text(10, 80, "Space: Build", 7)
+    img.text(10, 90, "U: Upgrade | Backspace: Sell", 7)
+    img.text(10, 100, "P: Pause", 7)
+    img.text(10, 110, "I: Tower Info", 7)
 
-def update_map_select():
-    global map_selection, game_state, enemy_paths, custom_map_exists, editor_message_shown
-    if pyxel.btnp(pyxel.KEY_UP):
-        map_selection = (map_selection - 1) % 3
-    if pyxel.btnp(pyxel.KEY_DOWN):
-        map_selection = (map_selection + 1) % 3
-    if pyxel.btnp(pyxel.KEY_RETURN):
-        if map_selection < 2:
-            game_state = STATE_GAME
-            enemy_paths, spawns, map_x_offset, map_y_offset = find_paths(2)
-            start_wave()
-        else:
-            # custom map logic
-            if not custom_map_exists:
-                game_state = STATE_MAP_EDITOR
-            else:
-                enemy_paths, spawns, map_x_offset, map_y_offset = find_paths(2)
-                if enemy_paths:
-                    game_state = STATE_GAME
-                    start_wave()
-                else:
-                    game_state = STATE_MAP_EDITOR
-    if pyxel.btnp(pyxel.KEY_D) and custom_map_exists:
-        tm = pyxel.tilemaps[0]
-        for yy in range(16, 32):
-            for xx in range(16, 32):
-                tm.pset(xx, yy, (3, 0))
-        custom_map_exists = False
-    if pyxel.btnp(pyxel.KEY_BACKSPACE):
-        game_state = STATE_MENU
-        
-def draw_map_select():
-    pyxel.cls(0)
-    pyxel.text(40, 30, "SELECT MAP", 10)
-    blink = (pyxel.frame_count // 15) % 2 == 0
-    color1 = 7 if map_selection == 0 and blink else 5
-    color2 = 7 if map_selection == 1 and blink else 5
-    color3 = 7 if map_selection == 2 and blink else 5
-
-    pyxel.text(40, 60, "Map 1", color1)
-    pyxel.text(40, 72, "Map 2", color2)
+menu_prompt = UIText(25, 30, 80, 6,
+    lambda: 7 if (pyxel.frame_count // 30) % 2 == 0 else 1,
+    lambda col: [("Press ENTER to Start", col)])
 
-    if not custom_map_exists:
-        pyxel.text(40, 84, "Create Map", color3)
+def draw_menu():
+    blit_screen(cached_screen("menu", build_menu))
+    menu_prompt.draw()
+
+def build_map_select(img):
+    img.text(40, 30, "SELECT MAP", 10)
+    img.text(10, 120, "Backspace: Return to menu", 5)
+
+def map_select_lines(value):
+    selection, blink, has_custom = value
+    color1 = 7 if selection == 0 and blink else 5
+    color2 = 7 if selection == 1 and blink else 5
+    color3 = 7 if selection == 2 and blink else 5
+
+    lines = [("Map 1", color1), ("Map 2", color2)]
+    if not has_custom:
+        lines.append(("Create Map", color3))
     else:
-        pyxel.text(40, 84, "Play Map", color3)
-        pyxel.text(40, 96, "Edit Map (E)", 6)
-        pyxel.text(40, 108, "Delete Map (D)", 6)
+        lines.append(("Play Map", color3))
+        lines.append(("Edit Map (E)", 6))
+        lines.append(("Delete Map (D)", 6))
+    return lines
+
+map_select_items = UIText(40, 60, 64, 54,
+    lambda: (map_selection, (pyxel.frame_count // 15) % 2 == 0, custom_map_exists),
+    map_select_lines, line_h=12)
+
+def draw_map_select():
+    blit_screen(cached_screen("map_select", build_map_select))
+    map_select_items.draw()
 
     if pyxel.btnp(pyxel.KEY_E) and custom_map_exists:
         game_state = STATE_MAP_EDITOR
-
-    pyxel.text(10, 120, "Backspace: Return to menu", 5)
     
 # pause
 def update_pause():
     global game_state, pause_selection
 
-    if pyxel.btnp(pyxel.KEY_UP):
+    if btnp(pyxel.KEY_UP):
         pause_selection = (pause_selection - 1) % 2
-    elif pyxel.btnp(pyxel.KEY_DOWN):
+    elif btnp(pyxel.KEY_DOWN):
         pause_selection = (pause_selection + 1) % 2
 
-    if pyxel.btnp(pyxel.KEY_RETURN):
+    if btnp(pyxel.KEY_RETURN):
         if pause_selection == 0:
             game_state = STATE_GAME
         elif pause_selection == 1:
@@ -592,9 +1429,9 @@ def draw_pause():
 
 def update_boss_choice():
     global game_state, infinite_mode, pause_selection, wave
-    if pyxel.btnp(pyxel.KEY_UP) or pyxel.btnp(pyxel.KEY_DOWN):
+    if btnp(pyxel.KEY_UP) or btnp(pyxel.KEY_DOWN):
         pause_selection = 1 - pause_selection
-    if pyxel.btnp(pyxel.KEY_RETURN):
+    if btnp(pyxel.KEY_RETURN):
         if pause_selection == 0:
             reset_game()
         else:
@@ -613,11 +1450,168 @@ def draw_boss_choice():
 
 # map editor
 editor_save_message = ""
-editor_save_timer = 0
+editor_save_timer = None
+
+# editor messages hide themselves through ui_timers
+def show_editor_message(lines, frames=180):
+    global editor_message, editor_msg_timer
+    editor_message = lines
+    if editor_msg_timer:
+        ui_timers.cancel(editor_msg_timer)
+    editor_msg_timer = ui_timers.schedule(frames, hide_editor_message)
+
+def hide_editor_message():
+    global editor_msg_timer
+    editor_msg_timer = None
+
+def show_save_message(msg, frames=120):
+    global editor_save_message, editor_save_timer
+    editor_save_message = msg
+    if editor_save_timer:
+        ui_timers.cancel(editor_save_timer)
+    editor_save_timer = ui_timers.schedule(frames, hide_save_message)
+
+def hide_save_message():
+    global editor_save_message, editor_save_timer
+    editor_save_message = ""
+    editor_save_timer = None
+
+# editor edits
+# an edit covers a list of row spans (y, x0, x1) in tilemap coordinates. the
+# rows under the spans are copied out of the tilemap buffer before and after
+# the edit and only the rows that changed are kept, so undo and redo write
+# one slice per row and the history grows with the edits, not with the map
+EDITOR_HISTORY = 100
+editor_undo = []
+editor_redo = []
+editor_mark = None       # other corner of the selection, in map tiles
+editor_clipboard = None  # w, h and the copied rows
+
+def tile_buffer():
+    # u, v of every tile as uint16, row by row
+    tm = pyxel.tilemaps[0]
+    return memoryview(tm.data_ptr()).cast("B").cast("H"), tm.width
+
+def read_spans(spans):
+    tiles, width = tile_buffer()
+    return [tiles[(y * width + x0) * 2:(y * width + x1) * 2].tobytes() for y, x0, x1 in spans]
+
+def write_spans(spans, rows):
+    tiles, width = tile_buffer()
+    for (y, x0, x1), row in zip(spans, rows):
+        tiles[(y * width + x0) * 2:(y * width + x1) * 2] = memoryview(row).cast("H")
+
+def rect_spans(x, y, w, h):
+    return [(yy, x, x + w) for yy in range(y, y + h)]
+
+def edit_map(spans, edit):
+    global custom_map_exists
+    before = read_spans(spans)
+    edit()
+    after = read_spans(spans)
+    changed = [i for i in range(len(spans)) if before[i] != after[i]]
+    if not changed:
+        return
+    editor_undo.append(([spans[i] for i in changed], [before[i] for i in changed], [after[i] for i in changed]))
+    del editor_undo[:-EDITOR_HISTORY]
+    editor_redo.clear()
+    invalidate_map(2)
+    custom_map_exists = True
+
+def apply_edit(spans, rows):
+    global custom_map_exists
+    write_spans(spans, rows)
+    invalidate_map(2)
+    custom_map_exists = True
+
+def undo_edit():
+    if not editor_undo:
+        return False
+    spans, before, after = edit = editor_undo.pop()
+    apply_edit(spans, before)
+    editor_redo.append(edit)
+    return True
+
+def redo_edit():
+    if not editor_redo:
+        return False
+    spans, before, after = edit = editor_redo.pop()
+    apply_edit(spans, after)
+    editor_undo.append(edit)
+    return True
+
+def fill_rect(x, y, w, h, tile):
+    edit_map(rect_spans(x, y, w, h), lambda: pyxel.tilemaps[0].rect(x, y, w, h, tile))
+
+def flood_fill(tx, ty, tile):
+    # scanline fill of the tiles connected to tx, ty that look like it, the
+    # runs are found first and then each one is filled with a single rect
+    tiles, width = tile_buffer()
+    x0, y0 = MAP_SRC_TILE_X[2], MAP_SRC_TILE_Y[2]
+    map_w, map_h = MAP_SIZES[2]
+
+    def at(x, y):
+        i = (y * width + x) * 2
+        return (tiles[i], tiles[i + 1])
+
+    target = at(tx, ty)
+    if target == tuple(tile):
+        return
+    spans = []
+    done = set()
+    seeds = [(tx, ty)]
+    while seeds:
+        x, y = seeds.pop()
+        l = x
+        while l > x0 and at(l - 1, y) == target:
+            l -= 1
+        if (y, l) in done:
+            continue
+        done.add((y, l))
+        r = x + 1
+        while r < x0 + map_w and at(r, y) == target:
+            r += 1
+        spans.append((y, l, r))
+        # one seed per run of matching tiles above and below
+        for ny in (y - 1, y + 1):
+            if not y0 <= ny < y0 + map_h:
+                continue
+            inside = False
+            for xx in range(l, r):
+                match = at(xx, ny) == target
+                if match and not inside:
+                    seeds.append((xx, ny))
+                inside = match
+
+    def fill():
+        tm = pyxel.tilemaps[0]
+        for y, l, r in spans:
+            tm.rect(l, y, r - l, 1, tile)
+    edit_map(spans, fill)
+
+def selection():
+    # tilemap rectangle between the mark and the cursor, or the cursor tile
+    mx, my = editor_mark or (cursor_x, cursor_y)
+    x = MAP_SRC_TILE_X[2] + min(mx, cursor_x)
+    y = MAP_SRC_TILE_Y[2] + min(my, cursor_y)
+    return x, y, abs(mx - cursor_x) + 1, abs(my - cursor_y) + 1
+
+def copy_selection():
+    global editor_clipboard
+    x, y, w, h = selection()
+    editor_clipboard = (w, h, read_spans(rect_spans(x, y, w, h)))
+
+def paste_clipboard():
+    # top left at the cursor, cut off at the edge of the map
+    w, h, rows = editor_clipboard
+    map_w, map_h = MAP_SIZES[2]
+    w = min(w, map_w - cursor_x)
+    h = min(h, map_h - cursor_y)
+    spans = rect_spans(MAP_SRC_TILE_X[2] + cursor_x, MAP_SRC_TILE_Y[2] + cursor_y, w, h)
+    edit_map(spans, lambda: write_spans(spans, [row[:w * 4] for row in rows[:h]]))
 
 def update_map_select():
     global map_selection, game_state, enemy_paths, custom_map_exists
-    global editor_message, editor_msg_timer
 
     # select maps
     if pyxel.btnp(pyxel.KEY_UP):
@@ -627,71 +1621,84 @@ def update_map_select():
 
     # play map
     if pyxel.btnp(pyxel.KEY_RETURN):
+        enter_map(map_selection)
         if map_selection < 2:
             game_state = STATE_GAME
-            enemy_paths, spawns, map_x_offset, map_y_offset = find_paths(map_selection)
+            enemy_paths, spawns, map_x_offset, map_y_offset = get_paths(map_selection)
             start_wave()
         else:
             if not custom_map_exists:
                 game_state = STATE_MAP_EDITOR
-                editor_message = ["Connect portals", "to bases in order to play"]
-                editor_msg_timer = 180
+                show_editor_message(["Connect portals", "to bases in order to play"])
             else:
-                enemy_paths, spawns, map_x_offset, map_y_offset = find_paths(2)
+                enemy_paths, spawns, map_x_offset, map_y_offset = get_paths(2)
                 if enemy_paths:
                     game_state = STATE_GAME
                     start_wave()
                 else:
                     game_state = STATE_MAP_EDITOR
-                    editor_message = ["Connect portals", "to bases in order to play"]
-                    editor_msg_timer = 180
+                    show_editor_message(["Connect portals", "to bases in order to play"])
 
     # edit custom map
     if pyxel.btnp(pyxel.KEY_E):
         game_state = STATE_MAP_EDITOR
-        editor_message = ["Connect portals", "to bases in order to play"]
-        editor_msg_timer = 180
+        enter_map(2)
+        show_editor_message(["Connect portals", "to bases in order to play"])
 
     # delete custom map
     if pyxel.btnp(pyxel.KEY_D) and custom_map_exists:
-        tm = pyxel.tilemaps[0]
-        for yy in range(16, 32):
-            for xx in range(16, 32):
-                tm.pset(xx, yy, (3, 0))
+        w, h = MAP_SIZES[2]
+        fill_rect(MAP_SRC_TILE_X[2], MAP_SRC_TILE_Y[2], w, h, (3, 0))
         custom_map_exists = False
 
     # return to menu
     if pyxel.btnp(pyxel.KEY_BACKSPACE):
         game_state = STATE_MENU
 
+EDITOR_TILE_NAMES = {(3,0):"Grass",(1,2):"Tree",(1,0):"Path",(7,0):"Base",(5,0):"Portal"}
+
+def build_map_editor(img):
+    # transparent overlay, the tilemap under it stays live
+    img.text(3, 5, "MAP EDITOR (Custom Map)", 10)
+    img.text(3,13, "Press P to return and play", 10)
+
+    img.text(3, 28, "1 = Grass | 2 = Tree | 3 = Path", 7)
+    img.text(3, 36, "4 = Base | 5 = Portal", 7)
+    img.text(3, 44, "M mark | F flood | X clear", 7)
+    img.text(3, 52, "C/V copy/paste | Z/Y undo/redo", 7)
+
+editor_tile_label = UIText(5, 118, 120, 6,
+    lambda: editor_selected_tile,
+    lambda tile: [(f"Selected tile: {EDITOR_TILE_NAMES.get(tile, 'Unknown')}", 7)])
+
+editor_save_label = UIText(40, 100, 88, 6,
+    lambda: editor_save_message or None,
+    lambda msg: [(msg, 10)])
+
+editor_msg_label = UIText(20, 50, 108, 16,
+    lambda: tuple(editor_message) if editor_msg_timer else None,
+    lambda msg: [(msg[0], 10), (msg[1], 10)])
+
 def draw_map_editor():
     pyxel.cls(0)
-    pyxel.bltm(0, 0, 0, 128, 128, 128, 128)
-    pyxel.text(3, 5, "MAP EDITOR (Custom Map)", 10)
-    pyxel.text(3,13, "Press P to return and play", 10)
-    
-    pyxel.text(3, 28, "1 = Grass | 2 = Tree | 3 = Path", 7)
-    pyxel.text(3, 36, "4 = Base | 5 = Portal", 7)
+    pyxel.camera(cam_x, cam_y)
+    draw_tilemap(2)
     pyxel.rectb(cursor_x*TILE_SIZE, cursor_y*TILE_SIZE, TILE_SIZE, TILE_SIZE, 7)
+    if editor_mark:
+        x, y, w, h = selection()
+        pyxel.rectb((x - MAP_SRC_TILE_X[2]) * TILE_SIZE, (y - MAP_SRC_TILE_Y[2]) * TILE_SIZE,
+                    w * TILE_SIZE, h * TILE_SIZE, 10)
+    pyxel.camera()
+    blit_screen(cached_screen("map_editor", build_map_editor), 0)
 
-    tile_names = {(3,0):"Grass",(1,2):"Tree",(1,0):"Path",(7,0):"Base",(5,0):"Portal"}
-    name = tile_names.get(editor_selected_tile, "Unknown")
-    pyxel.text(5, 118, f"Selected tile: {name}", 7)
-
-    if editor_save_message:
-        pyxel.text(40, 100, editor_save_message, 10)
+    editor_tile_label.draw()
+    editor_save_label.draw()
 
-        global editor_msg_timer, editor_message
-    if editor_msg_timer > 0:
-        x = 20
-        y = 50
-        pyxel.text(x, y, editor_message[0], 10)
-        pyxel.text(x, y + 10, editor_message[1], 10)
-        editor_msg_timer -= 1
+    if editor_msg_timer:
+        editor_msg_label.draw()
 
 def update_map_editor():
-    global cursor_x, cursor_y, editor_selected_tile, custom_map_exists, game_state
-    global editor_save_message, editor_save_timer
+    global cursor_x, cursor_y, editor_selected_tile, game_state, editor_mark, editor_clipboard
 
     # move cursor
     if pyxel.btnp(pyxel.KEY_LEFT):
@@ -715,19 +1722,31 @@ def update_map_editor():
     if pyxel.btnp(pyxel.KEY_5):
         editor_selected_tile = (5, 0)
 
-    # map editor placing logic
+    # map editor placing logic, with a mark the whole selection is filled
     if pyxel.btnp(pyxel.KEY_SPACE):
-        tm = pyxel.tilemaps[0]
-        tx = cursor_x + 16
-        ty = cursor_y + 16
-        tm.pset(tx, ty, editor_selected_tile)
-        custom_map_exists = True
-
-    # save confirmation text 
-    if editor_save_timer > 0:
-        editor_save_timer -= 1
-        if editor_save_timer == 0:
-            editor_save_message = ""
+        fill_rect(*selection(), editor_selected_tile)
+        editor_mark = None
+    if pyxel.btnp(pyxel.KEY_F):
+        flood_fill(cursor_x + MAP_SRC_TILE_X[2], cursor_y + MAP_SRC_TILE_Y[2], editor_selected_tile)
+    if pyxel.btnp(pyxel.KEY_X):
+        fill_rect(*selection(), (3, 0))
+        editor_mark = None
+
+    # selection, copy and paste
+    if pyxel.btnp(pyxel.KEY_M):
+        editor_mark = None if editor_mark else (cursor_x, cursor_y)
+    if pyxel.btnp(pyxel.KEY_C):
+        copy_selection()
+        editor_mark = None
+        show_save_message("Copied %dx%d" % editor_clipboard[:2])
+    if pyxel.btnp(pyxel.KEY_V) and editor_clipboard:
+        paste_clipboard()
+
+    # history
+    if pyxel.btnp(pyxel.KEY_Z):
+        show_save_message("Undo" if undo_edit() else "Nothing to undo")
+    if pyxel.btnp(pyxel.KEY_Y):
+        show_save_message("Redo" if redo_edit() else "Nothing to redo")
 
     # return to map select
     if pyxel.btnp(pyxel.KEY_P):
@@ -736,178 +1755,367 @@ def update_map_editor():
 
 def move_editor_cursor(dx, dy):
     global cursor_x, cursor_y
-    cursor_x = max(0, min(MAP_TILES_W - 1, cursor_x + dx))
-    cursor_y = max(0, min(MAP_TILES_H - 1, cursor_y + dy))
+    map_w, map_h = MAP_SIZES[2]
+    cursor_x = max(0, min(map_w - 1, cursor_x + dx))
+    cursor_y = max(0, min(map_h - 1, cursor_y + dy))
+    follow_cursor(2)
+
+def spawn_round():
+    global spawn_rounds_done
+    # enemy spawn logic
+    base_spawn = 2
+    spawn_count_per_portal = base_spawn + (wave - 1)  # +1 per wave
+
+    # fast enemies logic
+    fast_enemy_count = 0
+    if wave >= 2:
+        fast_enemy_count = 2 + (wave - 2)
+
+    paths, spawns, map_x_offset, map_y_offset = get_paths(map_selection)
+
+    for portal, spawn in enumerate(spawns):
+        sx, sy = spawn
+        local_paths = [p for p in paths if p and (p[0][0] + map_x_offset, p[0][1] + map_y_offset) == (sx, sy)]
+        path = local_paths[0] if local_paths else (paths[0] if paths else [])
+
+        for k in range(spawn_count_per_portal):
+            if not path:
+                continue
+            if k < fast_enemy_count:
+                e = FastEnemy(path)
+                e.hp = 6 + wave * 2
+                e.reward = 6 + wave
+            else:
+                e = Enemy(path, hp=4 + wave * 2, reward=5 + wave)
+            enemy_arena.add(e)
+
+            # spawn at portal center
+            e.px = (sx - map_x_offset) * TILE_SIZE
+            e.py = (sy - map_y_offset) * TILE_SIZE
+            e.portal = portal
+            e.on_path = (sx - map_x_offset, sy - map_y_offset) == path[0]
+
+    spawn_rounds_done += 1
+    wake_parked()
 
 def update_game():
-    global cursor_x, cursor_y, enemies, money, wave, wave_active, wave_timer, projectiles, base_hp
-    global spawn_rounds_done, boss_pending, boss_active, selected_tower_type, game_state, pause_selection, infinite_mode
+    if alloc_on:
+        alloc_phase(ALLOC_INPUT)
+    if not game_input():
+        return
+
+    # waves/spawning
+    if wave_active:
+        if alloc_on:
+            alloc_phase(ALLOC_SPAWN)
+        spawn_tick()
+
+        if alloc_on:
+            alloc_phase(ALLOC_ENEMIES)
+        for e in enemies:
+            e.update()
+        if alloc_on:
+            alloc_phase(ALLOC_WAVES)
+        enemy_arena.compact()
+        if not wave_checks():
+            return
+
+    if alloc_on:
+        alloc_phase(ALLOC_TOWERS)
+    for t in tower_tick():
+        t.update(enemies, projectiles)
+    awake_towers[:] = [t for t in awake_towers if t.awake]
+
+    if alloc_on:
+        alloc_phase(ALLOC_PROJECTILES)
+    for p in projectiles:
+        p.update()
+    projectile_arena.compact()
+
+# the parts of a game tick, update_game runs them around the entity updates
+# and a batch engine around its own. each returns false when the tick ends
+def game_input():
+    global cursor_x, cursor_y, money, selected_tower_type, game_state, pause_selection, game_tick
+    game_tick += 1
 
     # win/lose
     if (wave > max_waves and not infinite_mode) or base_hp <= 0:
-        if pyxel.btnp(pyxel.KEY_RETURN):
+        if btnp(pyxel.KEY_RETURN):
             reset_game()
-        return
+        return False
 
     if base_hp <= 0:
-        if pyxel.btnp(pyxel.KEY_RETURN):
+        if btnp(pyxel.KEY_RETURN):
             reset_game()
-        return
+        return False
 
-    if pyxel.btnp(pyxel.KEY_P):
+    if injected_keys is not None and not injected_keys:
+        # a replayed tick without keys, none of the below would do anything
+        return True
+
+    if btnp(pyxel.KEY_P):
         game_state = STATE_PAUSE
         pause_selection = 0
-        return
+        return False
 
     # cursor movement
-    if pyxel.btnp(pyxel.KEY_RIGHT): cursor_x = min(MAP_TILES_W - 1, cursor_x + 1)
-    if pyxel.btnp(pyxel.KEY_LEFT): cursor_x = max(0, cursor_x - 1)
-    if pyxel.btnp(pyxel.KEY_DOWN): cursor_y = min(MAP_TILES_H - 1, cursor_y + 1)
-    if pyxel.btnp(pyxel.KEY_UP): cursor_y = max(0, cursor_y - 1)
+    map_w, map_h = MAP_SIZES[map_selection]
+    if btnp(pyxel.KEY_RIGHT): cursor_x = min(map_w - 1, cursor_x + 1)
+    if btnp(pyxel.KEY_LEFT): cursor_x = max(0, cursor_x - 1)
+    if btnp(pyxel.KEY_DOWN): cursor_y = min(map_h - 1, cursor_y + 1)
+    if btnp(pyxel.KEY_UP): cursor_y = max(0, cursor_y - 1)
+    follow_cursor(map_selection)
 
     # tower selection
-    if pyxel.btnp(pyxel.KEY_1): selected_tower_type = 0
-    if pyxel.btnp(pyxel.KEY_2): selected_tower_type = 1
-    if pyxel.btnp(pyxel.KEY_3): selected_tower_type = 2
+    if btnp(pyxel.KEY_1): selected_tower_type = 0
+    if btnp(pyxel.KEY_2): selected_tower_type = 1
+    if btnp(pyxel.KEY_3): selected_tower_type = 2
 
     # build logic
-    if pyxel.btnp(pyxel.KEY_SPACE):
+    if btnp(pyxel.KEY_SPACE):
         abs_x = cursor_x + MAP_SRC_TILE_X[map_selection]
         abs_y = cursor_y + MAP_SRC_TILE_Y[map_selection]
-        tile = pyxel.tilemaps[0].pget(abs_x, abs_y)
-        occupied = any((t.tx == cursor_x and t.ty == cursor_y and t.map_index == map_selection) for t in towers)
+        tile = tile_at(abs_x, abs_y)
+        occupied = tower_at(cursor_x, cursor_y) is not None
         if is_grass(tile) and not occupied:
             # increased cost based on the number of towers placed
             build_price = [COST_NORMAL, COST_AOE, COST_DRONE][selected_tower_type] + len(towers) * 10
             if money >= build_price:
                 money -= build_price
                 if selected_tower_type == 0:
-                    towers.append(NormalTower(cursor_x, cursor_y, map_selection))
+                    add_tower(NormalTower(cursor_x, cursor_y, map_selection))
                 elif selected_tower_type == 1:
-                    towers.append(AOETower(cursor_x, cursor_y, map_selection))
+                    add_tower(AOETower(cursor_x, cursor_y, map_selection))
                 elif selected_tower_type == 2:
-                    towers.append(DroneTower(cursor_x, cursor_y, map_selection))
+                    add_tower(DroneTower(cursor_x, cursor_y, map_selection))
 
-    if pyxel.btnp(pyxel.KEY_I):
+    if btnp(pyxel.KEY_I):
         global show_info
         show_info = not show_info
 
     # upgrade
-    if pyxel.btnp(pyxel.KEY_U):
-        for t in towers:
-            if t.tx == cursor_x and t.ty == cursor_y and t.map_index == map_selection:
-                t.upgrade()
+    if btnp(pyxel.KEY_U):
+        t = tower_at(cursor_x, cursor_y)
+        if t:
+            t.upgrade()
 
     # sell
-    if pyxel.btnp(pyxel.KEY_BACKSPACE):
-        for t in towers:
-            if t.tx == cursor_x and t.ty == cursor_y and t.map_index == map_selection:
-                money += t.sell_value()
-                towers.remove(t)
-                break
-
-    # waves/spawning
-    if wave_active:
-        wave_timer += 1
-
-        if spawn_rounds_done < SPAWN_ROUNDS_PER_WAVE and wave_timer % SPAWN_INTERVAL_FRAMES == 0:
-            # enemy spawn logic
-            base_spawn = 2
-            spawn_count_per_portal = base_spawn + (wave - 1)  # +1 per wave
-
-            # fast enemies logic
-            fast_enemy_count = 0
-            if wave >= 2:
-                fast_enemy_count = 2 + (wave - 2)
-
-            paths, spawns, map_x_offset, map_y_offset = find_paths(map_selection)
-
-            for spawn in spawns:
-                sx, sy = spawn
-                local_paths = [p for p in paths if p and (p[0][0] + map_x_offset, p[0][1] + map_y_offset) == (sx, sy)]
-                path = local_paths[0] if local_paths else (paths[0] if paths else [])
-
-                for k in range(spawn_count_per_portal):
-                    if not path:
-                        continue
-                    if k < fast_enemy_count:
-                        e = FastEnemy(path)
-                        e.hp = 6 + wave * 2
-                        e.reward = 6 + wave
-                        enemies.append(e)
-                    else:
-                        e = Enemy(path, hp=4 + wave * 2, reward=5 + wave)
-                        enemies.append(e)
-
-                    # spawn at portal center
-                    enemies[-1].px = (sx - map_x_offset) * TILE_SIZE
-                    enemies[-1].py = (sy - map_y_offset) * TILE_SIZE
-
-            spawn_rounds_done += 1
-
-        for e in enemies:
-            e.update()
-        enemies = [e for e in enemies if e.alive]
-
-        # boss spawn
-        if boss_pending and spawn_rounds_done >= SPAWN_ROUNDS_PER_WAVE and len(enemies) == 0 and not boss_active:
-            paths, _, _, _ = find_paths(map_selection)
-            if paths:
-                boss_active = True
-                boss_pending = False
-                boss_count = max(1, wave // 10)
-                for i in range(boss_count):
-                    path = paths[i % len(paths)]
-                    boss = BossEnemy(path)
-                    boss.hp = 400 + (wave * 70) + ((wave // 10) * 200)
-                    boss.reward = 150 + (wave * 15)
-                    enemies.append(boss)
-
-        # defeat screen
-        if boss_active and not any(isinstance(e, BossEnemy) and e.alive for e in enemies):
-            boss_active = False
-            pause_selection = 0
-            if wave % 10 == 0:
-                game_state = STATE_BOSS_CHOICE
-            return
-
-        # end of wave
-        if spawn_rounds_done >= SPAWN_ROUNDS_PER_WAVE and len(enemies) == 0 and not boss_active:
-            wave_active = False
-            if not infinite_mode and wave >= max_waves:
-                return
+    if btnp(pyxel.KEY_BACKSPACE):
+        t = tower_at(cursor_x, cursor_y)
+        if t:
+            money += t.sell_value()
+            remove_tower(t)
+    return True
+
+def spawn_tick():
+    global wave_timer
+    wave_timer += 1
+    wave_timers.advance()
+
+def wave_checks():
+    # after the enemies moved. a batch engine keeps the enemies of its worlds
+    # in columns, batch_live then holds how many of a world's are left and
+    # how many of those are bosses
+    global money, wave, wave_active, boss_pending, boss_active, game_state, pause_selection
+    if base_hp <= 0:
+        # game over ends the wave, nothing else runs this tick
+        end_wave_reports()
+        return False
+
+    # boss spawn
+    if boss_pending and spawn_rounds_done >= SPAWN_ROUNDS_PER_WAVE and len(enemies) + batch_live[0] == 0 and not boss_active:
+        paths, spawns, map_x_offset, map_y_offset = get_paths(map_selection)
+        if paths:
+            boss_active = True
+            boss_pending = False
+            boss_count = max(1, wave // 10)
+            for i in range(boss_count):
+                path = paths[i % len(paths)]
+                boss = BossEnemy(path)
+                boss.hp = 400 + (wave * 70) + ((wave // 10) * 200)
+                boss.reward = 150 + (wave * 15)
+                boss.portal = spawns.index((path[0][0] + map_x_offset, path[0][1] + map_y_offset))
+                enemy_arena.add(boss)
+            wake_parked()
+
+    # defeat screen
+    if boss_active and not batch_live[1] and not any(isinstance(e, BossEnemy) and e.alive for e in enemies):
+        boss_active = False
+        pause_selection = 0
+        if wave % 10 == 0:
+            game_state = STATE_BOSS_CHOICE
+            end_wave_reports()
+        return False
+
+    # end of wave
+    if spawn_rounds_done >= SPAWN_ROUNDS_PER_WAVE and len(enemies) + batch_live[0] == 0 and not boss_active:
+        wave_active = False
+        if not infinite_mode and wave >= max_waves:
+            end_wave_reports()
+            return False
+        else:
+            money += 10
+            if telemetry_on:
+                tel_ring[tel_row + TEL_MONEY_WAVE] += 10
+            end_wave_reports()
+            wave += 1
+            boss_pending = (wave % 10 == 0)
+            start_wave()
+    return True
+
+def tower_tick():
+    # reloads finishing this tick wake their towers, returns the ones to
+    # update, sleeping ones are skipped
+    global target_index
+    target_index = None
+    tower_timers.advance()
+    return [t for t in awake_towers if t.map_index == map_selection]
+
+# sprite compositor
+# draws every enemy, tower, drone and projectile of a frame at once. stamps
+# are grouped by sprite, each sprite keeps the frame offsets and colours of
+# its opaque pixels from image bank 0, and every group is written into a copy
+# of the screen with a margin so nothing needs clipping. where stamps overlap
+# the last one in draw order wins, so the frame is the same as blitting them
+# one by one, and the copy goes back to the screen in one go
+SHOT = -1  # sprite key of a projectile, the radius 1 circle is a plus
+PAD = 8
+
+class Compositor:
+    def __init__(self):
+        bank = pyxel.images[0]
+        self.bank_w = bank.width
+        self.bank = np.ctypeslib.as_array(bank.data_ptr(), shape=(bank.width * bank.height,)).reshape(bank.height, bank.width)
+        self.screen = np.ctypeslib.as_array(pyxel.screen.data_ptr(), shape=(WIDTH * HEIGHT,)).reshape(HEIGHT, WIDTH)
+        self.fw = WIDTH + 2 * PAD
+        self.frame = np.zeros((HEIGHT + 2 * PAD, self.fw), np.uint8)
+        self.pixels = self.frame.reshape(-1)
+        self.view = self.frame[PAD:PAD + HEIGHT, PAD:PAD + WIDTH]
+        self.sprites = {SHOT: (np.array([1, self.fw, self.fw + 1, self.fw + 2, 2 * self.fw + 1], np.int32), np.full(5, 7, np.uint8))}
+        self.chunks = []
+
+    def key(self, u, v):
+        return v * self.bank_w + u
+
+    def sprite(self, key):
+        s = self.sprites.get(key)
+        if s is None:
+            v, u = divmod(key, self.bank_w)
+            tile = self.bank[v:v + 8, u:u + 8]
+            dy, dx = np.nonzero(tile)
+            s = self.sprites[key] = ((dy * self.fw + dx).astype(np.int32), tile[dy, dx])
+        return s
+
+    def draw(self, chunks):
+        # chunks of (x, y, key) columns in draw order, x, y the top left in
+        # world pixels, None draws the ring of the tower under the cursor
+        self.view[:] = self.screen
+        for chunk in chunks:
+            if chunk is None:
+                self.flush()
+                self.screen[:] = self.view
+                tower_at(cursor_x, cursor_y).draw_ui()
+                self.view[:] = self.screen
             else:
-                wave += 1
-                boss_pending = (wave % 10 == 0)
-                money += 10
-                start_wave()
+                self.chunks.append(chunk)
+        self.flush()
+        self.screen[:] = self.view
 
+    def flush(self):
+        if not self.chunks:
+            return
+        x, y, key = (np.concatenate(c) for c in zip(*self.chunks))
+        self.chunks = []
+        x = x.astype(np.int32) - cam_x
+        y = y.astype(np.int32) - cam_y
+        seen = np.flatnonzero((x > -8) & (x < WIDTH) & (y > -8) & (y < HEIGHT)).astype(np.int32)
+        base = (y[seen] + PAD) * self.fw + x[seen] + PAD
+        key = key[seen]
+        groups = []
+        for k in np.unique(key):
+            offsets, colours = self.sprite(int(k))
+            group = np.flatnonzero(key == k)
+            groups.append(((base[group, None] + offsets).ravel(), np.repeat(seen[group], len(offsets)), np.tile(colours, len(group))))
+        # the last stamp over a pixel wins
+        top = np.full(self.pixels.size, -1, np.int32)
+        for at, depth, colours in groups:
+            np.maximum.at(top, at, depth)
+        for at, depth, colours in groups:
+            win = top[at] == depth
+            self.pixels[at[win]] = colours[win]
+
+def stamp_columns(stamps):
+    s = np.array(stamps, np.int64).reshape(-1, 3)
+    return s[:, 0], s[:, 1], s[:, 2]
+
+def tower_stamp(t):
+    sprites = (NORMAL_SPRITES, AOE_SPRITES, DRONE_TOWER_SPRITES)[t.kind]
+    sx, sy = sprites[max(0, min(2, t.level - 1))]
+    return (t.center_px() - 4, t.center_py() - 4, compositor.key(sx * 8, sy * 8))
+
+def drone_stamp(d):
+    sx, sy = DRONE_SPRITES[max(1, min(3, d.tower.level)) - 1]
+    return (int(d.x) - 4, int(d.y) - 4, compositor.key(sx * 8, sy * 8))
+
+def ring_tower():
+    # normal towers show their range while the cursor is on them
+    t = tower_at(cursor_x, cursor_y)
+    if isinstance(t, NormalTower) and in_view(t.tx * TILE_SIZE, t.ty * TILE_SIZE):
+        return t
+    return None
+
+def entity_chunks():
+    # same order as draw_game draws them, nothing is culled here
+    n = len(enemies)
+    sprites = list(map(attrgetter("sprite"), enemies))
+    keys = {s: compositor.key(s[0] * 8, s[1] * 8) for s in set(sprites)}
+    chunks = [(np.fromiter(map(attrgetter("px"), enemies), np.float64, n).astype(np.int64),
+               np.fromiter(map(attrgetter("py"), enemies), np.float64, n).astype(np.int64),
+               np.fromiter(map(keys.__getitem__, sprites), np.int64, n))]
+    ring = ring_tower()
+    stamps = []
     for t in towers:
-        if t.map_index == map_selection:
-            t.update(enemies, projectiles)
-
-    for p in projectiles:
-        p.update()
-    projectiles = [p for p in projectiles if p.alive]
-
+        if t.map_index != map_selection:
+            continue
+        stamps.append(tower_stamp(t))
+        if t is ring:
+            chunks += [stamp_columns(stamps), None]
+            stamps = []
+        elif t.kind == DroneTower.kind and t.drone:
+            stamps.append(drone_stamp(t.drone))
+    chunks.append(stamp_columns(stamps))
+    n = len(projectiles)
+    chunks.append((np.fromiter(map(attrgetter("x"), projectiles), np.float64, n).astype(np.int64) - 1,
+                   np.fromiter(map(attrgetter("y"), projectiles), np.float64, n).astype(np.int64) - 1,
+                   np.full(n, SHOT, np.int64)))
+    return chunks
 
 def draw_game():
     pyxel.cls(0)
-    if map_selection == 0:
-        pyxel.bltm(0, 0, 0, 0, 0, 128, 128)
-    elif map_selection == 1:
-        pyxel.bltm(0, 0, 0, 128, 0, 128, 128)
-    elif map_selection == 2:
-        pyxel.bltm(0, 0, 0, 128, 128, 128, 128)
+    pyxel.camera(cam_x, cam_y)
+    draw_tilemap(map_selection)
 
     # cursor
     pyxel.rectb(cursor_x * TILE_SIZE, cursor_y * TILE_SIZE, TILE_SIZE, TILE_SIZE, 7)
 
-    # enemies, towers, projectiles
-    for e in enemies: e.draw()
-    for t in towers:
-        if t.map_index == map_selection: t.draw()
-    for p in projectiles: p.draw()
+    # enemies, towers, projectiles, only the ones on screen
+    if sim_link is not None:
+        sim_link.draw_entities()
+    elif compositor is not None:
+        compositor.draw(entity_chunks())
+    else:
+        for e in enemies:
+            if in_view(e.px, e.py): e.draw()
+        for t in towers:
+            if t.map_index != map_selection:
+                continue
+            if in_view(t.tx * TILE_SIZE, t.ty * TILE_SIZE):
+                t.draw()
+            elif isinstance(t, DroneTower) and t.drone and in_view(t.drone.x - 4, t.drone.y - 4):
+                t.drone.draw()
+        for p in projectiles:
+            if in_view(p.x - 4, p.y - 4): p.draw()
+    pyxel.camera()
 
     if base_hp <= 0:
         pyxel.cls(0)
@@ -917,38 +2125,53 @@ def draw_game():
 
 
     # HUD
-    pyxel.text(2, 2, f"HP:{base_hp}", 8)
-    pyxel.text(40, 2, f"${money}", 9)
+    for w in hud_widgets:
+        w.draw()
 
+# HUD widgets, formatted only when the bound values change
+def wave_lines(value):
+    w, infinite = value
     # show wave info
-    if not infinite_mode:
-        if wave <= max_waves:
-            wave_text = f"W:{wave}/{max_waves}"
-        else:
-            wave_text = f"W:{wave}"
-    else:
-        wave_text = f"W:{wave}"
-    pyxel.text(80, 2, wave_text, 7)
+    if not infinite and w <= max_waves:
+        return [(f"W:{w}/{max_waves}", 7)]
+    return [(f"W:{w}", 7)]
 
+def selected_lines(value):
     # show selected tower type and its price
+    tower_type, tower_count = value
     names = ["Normal", "AOE", "Drone"]
-    build_price = [COST_NORMAL, COST_AOE, COST_DRONE][selected_tower_type] + len(towers) * 10
-    pyxel.text(2, 12, f"Sel: {names[selected_tower_type]} ${build_price} (1/2/3)", 7)
+    build_price = [COST_NORMAL, COST_AOE, COST_DRONE][tower_type] + tower_count * 10
+    return [(f"Sel: {names[tower_type]} ${build_price} (1/2/3)", 7)]
+
+def info_value():
+    if not show_info:
+        return None
+    t = tower_at(cursor_x, cursor_y)
+    if t is None:
+        return None
+    return (t.__class__.__name__, t.level, len(towers))
+
+def info_lines(value):
+    name, level, tower_count = value
+    lines = [("Tower Info:", 10), (f"Type: {name}", 7), (f"Level: {level}/3", 7)]
+    if level < 3:
+        upgrade_cost = (level * 20) + (tower_count * 10)
+        lines.append((f"Upgrade Price: ${upgrade_cost}", 7))
+    else:
+        lines.append(("Upgrade Price: N/A", 7))
+    return lines
 
-    if show_info:
-        for t in towers:
-            if t.map_index == map_selection and t.tx == cursor_x and t.ty == cursor_y:
-                pyxel.text(5, 85, f"Tower Info:", 10)
-                pyxel.text(5, 95, f"Type: {t.__class__.__name__}", 7)
-                pyxel.text(5, 105, f"Level: {t.level}/3", 7)
-
-                if t.level < 3:
-                    upgrade_cost = (t.level * 20) + (len(towers) * 10)
-                    pyxel.text(5, 115, f"Upgrade Price: ${upgrade_cost}", 7)
-                else:
-                    pyxel.text(5, 115, f"Upgrade Price: N/A", 7)
+hud_widgets = [
+    UIText(2, 2, 36, 6, lambda: base_hp, lambda hp: [(f"HP:{hp}", 8)]),
+    UIText(40, 2, 40, 6, lambda: money, lambda m: [(f"${m}", 9)]),
+    UIText(80, 2, 48, 6, lambda: (wave, infinite_mode), wave_lines),
+    UIText(2, 12, 124, 6, lambda: (selected_tower_type, len(towers)), selected_lines),
+    UIText(5, 85, 120, 36, info_value, info_lines),
+]
 
 def draw():
+    if alloc_on:
+        alloc_phase(ALLOC_DRAW)
     if game_state == STATE_MENU:
         draw_menu()
     elif game_state == STATE_MAP_SELECT:
@@ -962,14 +2185,994 @@ def draw():
     elif game_state == STATE_MAP_EDITOR:
         draw_map_editor()
 
+# determinism traces
+# every trace_every game ticks a line with the tick, a rolling hash and one
+# hash per field of the canonical state is written to the trace file, two
+# traces of the same session can then be compared with --compare-traces
+TRACE_FIELDS = ["enemies", "projectiles", "towers", "timers", "money", "wave", "base_hp"]
+
+game_tick = 0
+trace_file = None
+trace_every = 1
+trace_hash = 0
+
+def quantize(v):
+    # 1/16 px, so float noise well below a pixel doesn't count as a divergence
+    return int(round(v * 16))
+
+def state_hashes():
+    # sorted by seq, the order the old lists kept
+    e = array("q")
+    for en in sorted(enemies, key=attrgetter("seq")):
+        e.extend((quantize(en.px), quantize(en.py), en.hp, en.index, en.alive))
+    p = array("q")
+    for pr in sorted(projectiles, key=attrgetter("seq")):
+        p.extend((quantize(pr.x), quantize(pr.y), pr.damage, pr.aoe_radius, pr.alive))
+    t = array("q")
+    timers = array("q", (wave_timer, spawn_rounds_done))
+    for tw in towers:
+        t.extend((tw.tx, tw.ty, tw.map_index, tw.kind, tw.level))
+        timers.append(getattr(tw, "timer", 0))
+        if isinstance(tw, DroneTower) and tw.drone:
+            t.extend((quantize(tw.drone.x), quantize(tw.drone.y)))
+            timers.append(tw.drone.timer)
+    w = array("q", (wave, wave_active, boss_pending, boss_active, infinite_mode))
+    return [zlib.crc32(e.tobytes()), zlib.crc32(p.tobytes()), zlib.crc32(t.tobytes()),
+            zlib.crc32(timers.tobytes()), money & 0xffffffff, zlib.crc32(w.tobytes()),
+            base_hp & 0xffffffff]
+
+def trace_tick():
+    global trace_hash
+    if game_tick % trace_every:
+        return
+    fields = state_hashes()
+    trace_hash = zlib.crc32(struct.pack("<%dI" % len(fields), *fields), trace_hash)
+    trace_file.write("%d %08x %s\n" % (game_tick, trace_hash, " ".join("%08x" % h for h in fields)))
+
+def open_trace(path, every=1, append=False):
+    # a sim worker appends the ticks it plays to the file the window opened
+    global trace_file, trace_every, trace_hash
+    trace_file = open(path, "a" if append else "w")
+    trace_every = max(1, every)
+    trace_hash = 0
+    if not append:
+        trace_file.write("# tick hash %s\n" % " ".join(TRACE_FIELDS))
+        trace_file.flush()
+    atexit.register(trace_file.close)
+
+def read_trace(path):
+    fields = TRACE_FIELDS
+    rows = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == "#":
+                fields = parts[3:]
+                continue
+            rows.append((int(parts[0]), parts[1], parts[2:]))
+    return fields, rows
+
+def compare_traces(path_a, path_b):
+    # returns None when the traces match, else (tick, [diverging fields])
+    fields, rows_a = read_trace(path_a)
+    _, rows_b = read_trace(path_b)
+    for (tick_a, hash_a, fa), (tick_b, hash_b, fb) in zip(rows_a, rows_b):
+        if tick_a != tick_b:
+            return min(tick_a, tick_b), ["tick"]
+        if hash_a != hash_b:
+            return tick_a, [name for name, x, y in zip(fields, fa, fb) if x != y]
+    if len(rows_a) != len(rows_b):
+        shorter = rows_a if len(rows_a) < len(rows_b) else rows_b
+        return (shorter[-1][0] if shorter else 0), ["length"]
+    return None
+
+# scripted sessions, one line per frame with input: "<frame> KEY [KEY ...]"
+def load_script(path):
+    script = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split("#")[0].split()
+            if parts:
+                script[int(parts[0])] = {getattr(pyxel, "KEY_" + k.upper()) for k in parts[1:]}
+    return script
+
+def run_session(map_index, frames, script):
+    # runs the game headless from the start of wave 1 on map_index
+    global map_selection, game_state, enemy_paths, injected_keys
+    map_selection = map_index
+    game_state = STATE_GAME
+    enter_map(map_index)
+    enemy_paths = get_paths(map_index)[0]
+    start_wave()
+    for frame in range(frames):
+        injected_keys = script.get(frame, set())
+        update()
+        if game_state == STATE_MENU:
+            break
+    injected_keys = None
+
+def arg_value(name, default=None):
+    if name in sys.argv:
+        i = sys.argv.index(name)
+        if i + 1 < len(sys.argv):
+            return sys.argv[i + 1]
+    return default
+
+# worlds
+# a World keeps its own copy of every per-game global and swaps them into the
+# module while it runs, so one process can hold many games
+class World:
+    def __init__(self, map_index=0):
+        state = {
+            "game_state": STATE_GAME, "pause_selection": 0, "map_selection": map_index,
+            "cursor_x": 0, "cursor_y": 0, "cam_x": 0, "cam_y": 0, "show_info": False,
+            "selected_tower_type": 0, "base_hp": BASE_HP, "money": 50, "wave": 1,
+            "infinite_mode": False, "wave_active": False, "wave_timer": 0,
+            "spawn_rounds_done": 0, "boss_pending": False, "boss_active": False,
+            "enemy_paths": [], "towers": [],
+            "tower_index": {}, "awake_towers": [], "tower_seq": 0,
+            "tower_timers": TimerWheel(), "wave_timers": TimerWheel(),
+            "target_index": None, "batch_live": (0, 0), "game_tick": 0, "injected_keys": set(),
+            "tel_ring": array("i", bytes(4 * TEL_FIELDS * TELEMETRY_WAVES)), "tel_row": 0,
+            "enemy_arena": Arena(ENEMY_SLOTS), "projectile_arena": Arena(PROJECTILE_SLOTS),
+        }
+        state["enemies"] = state["enemy_arena"].items
+        state["projectiles"] = state["projectile_arena"].items
+        self.names = tuple(state)
+        self.slots = {name: i for i, name in enumerate(self.names)}
+        self.getter = itemgetter(*self.names)
+        self.values = tuple(state.values())
+        self.saved = None
+        global enemy_paths
+        with self:
+            enemy_paths = get_paths(map_index)[0]
+            start_wave()
+
+    def load(self):
+        globals().update(zip(self.names, self.values))
+
+    def store(self):
+        self.values = self.getter(globals())
+
+    def __enter__(self):
+        # keeps whatever game the module held before
+        self.saved = self.getter(globals())
+        self.load()
+        return self
+
+    def __exit__(self, *exc):
+        self.store()
+        globals().update(zip(self.names, self.saved))
+        self.saved = None
+
+    def __getitem__(self, name):
+        return self.values[self.slots[name]]
+
+    def __setitem__(self, name, value):
+        values = list(self.values)
+        values[self.slots[name]] = value
+        self.values = tuple(values)
+
+    def running(self):
+        return self["game_state"] != STATE_MENU
+
+    def step(self, keys=()):
+        # one frame of this game, the ui timers are the window's and don't run
+        global injected_keys
+        with self:
+            injected_keys = keys
+            update_state()
+
+# batch engine
+# steps many worlds in lockstep. their enemies and projectiles don't live in
+# the arenas of their worlds but in numpy columns, one row per entity with a
+# world column. enemy rows are kept in world and then seq order, so the first
+# row of a world that qualifies is the earliest spawned one. input, waves and
+# tower reloads still run inside each world, enemy movement, the target search
+# of every tower, projectile flight and impacts run for all the worlds at once.
+# drones fly and reload in their towers. the arenas of a world stay empty
+# while an engine runs it, and telemetry isn't counted
+ENEMY_COLUMNS = (("world", np.int64), ("seq", np.int64), ("x", np.float64), ("y", np.float64),
+                 ("hp", np.int64), ("index", np.int64), ("step", np.float64), ("path", np.int64),
+                 ("reward", np.int64), ("alive", bool), ("rewarded", bool), ("boss", bool)) if np else ()
+# target is the seq of an enemy of the same world, NO_TARGET for a shot at tx, ty
+SHOT_COLUMNS = (("world", np.int64), ("seq", np.int64), ("x", np.float64), ("y", np.float64),
+                ("target", np.int64), ("tx", np.float64), ("ty", np.float64), ("damage", np.int64),
+                ("speed", np.float64), ("radius", np.int64)) if np else ()
+NO_TARGET = -1
+LOST_TARGET = -2  # its enemy was gone before the engine took the shot over
+
+def empty_columns(columns):
+    return {name: np.zeros(0, dtype) for name, dtype in columns}
+
+def select_rows(cols, rows):
+    return {name: col[rows] for name, col in cols.items()}
+
+def segment_pairs(column, keys):
+    # pairs of (owner, row) for the rows of a sorted column equal to each key,
+    # owners in order, then where the rows of each owner start in the pairs
+    # and how many there are
+    start = np.searchsorted(column, keys)
+    count = np.searchsorted(column, keys, side="right") - start
+    first = np.cumsum(count) - count
+    owner = np.repeat(np.arange(len(keys)), count)
+    row = np.arange(count.sum()) - np.repeat(first - start, count)
+    return owner, row, first, count
+
+class BatchEngine:
+    def __init__(self, worlds):
+        self.worlds = worlds
+        self.enemies = empty_columns(ENEMY_COLUMNS)
+        self.shots = empty_columns(SHOT_COLUMNS)
+        # every path seen so far, points in px, stacked in one table
+        self.path_rows = {}
+        self.path_refs = []
+        self.path_start = np.zeros(0, np.int64)
+        self.path_len = np.zeros(0, np.int64)
+        self.path_xy = np.zeros((0, 2))
+        self.cleared = [None] * len(worlds)
+        new_enemies, new_shots = [], []
+        for k, w in enumerate(worlds):
+            self.take(k, w, new_enemies, new_shots)
+        self.add_rows(new_enemies, new_shots)
+
+    def path_row(self, path):
+        row = self.path_rows.get(id(path))
+        if row is None:
+            row = self.path_rows[id(path)] = len(self.path_refs)
+            self.path_refs.append(path)  # keeps id(path) from being reused
+            self.path_start = np.append(self.path_start, len(self.path_xy))
+            self.path_len = np.append(self.path_len, len(path))
+            self.path_xy = np.concatenate([self.path_xy, np.array(path, np.float64).reshape(-1, 2) * TILE_SIZE])
+        return row
+
+    def take(self, k, w, new_enemies, new_shots):
+        # drops the rows of a world whose arenas were cleared, then turns
+        # whatever its arenas got since into new rows
+        ea = w["enemy_arena"]
+        pa = w["projectile_arena"]
+        cleared = (ea.cleared, pa.cleared)
+        if cleared == self.cleared[k] and not ea.items and not pa.items:
+            return
+        if cleared != self.cleared[k]:
+            if self.cleared[k] is not None:
+                if cleared[0] != self.cleared[k][0]:
+                    self.enemies = select_rows(self.enemies, self.enemies["world"] != k)
+                if cleared[1] != self.cleared[k][1]:
+                    self.shots = select_rows(self.shots, self.shots["world"] != k)
+            self.cleared[k] = cleared
+        for p in sorted(pa.items, key=attrgetter("seq")):
+            if p.target is None:
+                target = NO_TARGET
+                tx, ty = p.point
+            else:
+                e = ea.get(p.target)
+                target = LOST_TARGET if e is None else e.seq
+                tx = ty = 0.0
+            new_shots.append((k, p.seq, p.x, p.y, target, tx, ty, p.damage, p.speed, p.aoe_radius))
+        for e in sorted(ea.items, key=attrgetter("seq")):
+            new_enemies.append((k, e.seq, e.px, e.py, e.hp, e.index, e.speed / 60.0, self.path_row(e.path),
+                                e.reward, e.alive, e.rewarded, isinstance(e, BossEnemy)))
+        if pa.items:
+            pa.take()
+        if ea.items:
+            ea.take()
+
+    def add_rows(self, new_enemies, new_shots):
+        if new_enemies:
+            cols = {name: np.concatenate([self.enemies[name], np.array(col, dtype)])
+                    for (name, dtype), col in zip(ENEMY_COLUMNS, zip(*new_enemies))}
+            # new rows have the highest seq of their world
+            self.enemies = select_rows(cols, np.argsort(cols["world"], kind="stable"))
+            new_enemies.clear()
+        if new_shots:
+            self.shots = {name: np.concatenate([self.shots[name], np.array(col, dtype)])
+                          for (name, dtype), col in zip(SHOT_COLUMNS, zip(*new_shots))}
+            new_shots.clear()
+
+    def step(self, keys=None):
+        # keys: one set of pressed keys per world, returns how many still run
+        global injected_keys, batch_live, money, base_hp
+        if not self.worlds:
+            return 0
+        n = len(self.worlds)
+        # worlds are swapped in with load/store, the module's own game is put
+        # back at the end
+        names = self.worlds[0].names
+        outer = self.worlds[0].getter(globals())
+        new_enemies, new_shots = [], []
+
+        # input and spawns, the pause and boss screens run as they are
+        moving = np.zeros(n, bool)
+        ticking = []
+        for k, w in enumerate(self.worlds):
+            if not w.running():
+                continue
+            w.load()
+            injected_keys = keys[k] if keys else set()
+            if game_state != STATE_GAME:
+                update_state()
+            elif game_input():
+                if wave_active:
+                    spawn_tick()
+                    moving[k] = True
+                ticking.append(k)
+            w.store()
+            self.take(k, w, new_enemies, new_shots)
+        self.add_rows(new_enemies, new_shots)
+
+        gained, leaked = self.move_enemies(moving)
+
+        # what the wave does now that they moved, then the reloads
+        world = self.enemies["world"]
+        live = np.bincount(world, minlength=n).tolist()
+        bosses = np.bincount(world[self.enemies["boss"] & self.enemies["alive"]], minlength=n).tolist()
+        fighting = []
+        for k in ticking:
+            w = self.worlds[k]
+            w.load()
+            fights = True
+            if moving[k]:
+                money += gained[k]
+                base_hp -= leaked[k]
+                batch_live = (live[k], bosses[k])
+                fights = wave_checks()
+                batch_live = (0, 0)
+            if fights:
+                fighting.append((k, tower_tick()))
+            w.store()
+            self.take(k, w, new_enemies, new_shots)
+        self.add_rows(new_enemies, new_shots)
+
+        gained = self.fire(fighting)
+        active = np.zeros(n, bool)
+        active[[k for k, _ in fighting]] = True
+        self.move_shots(active)
+        for k, towers in fighting:
+            w = self.worlds[k]
+            if towers:
+                awake = w["awake_towers"]
+                awake[:] = [t for t in awake if t.awake]
+            if gained[k]:
+                w["money"] = w["money"] + gained[k]
+        globals().update(zip(names, outer))
+        return sum(w.running() for w in self.worlds)
+
+    def move_enemies(self, moving):
+        # same branches as Enemy.update for the worlds whose wave runs,
+        # returns the rewards and the leaks of each world
+        n = len(self.worlds)
+        e = self.enemies
+        world = e["world"]
+        gained = np.zeros(n, np.int64)
+        mv = moving[world]
+        dead = mv & (e["hp"] <= 0)
+        index = e["index"]
+        leak = mv & ~dead & (index >= self.path_len[e["path"]] - 1)
+        paid = dead & ~e["rewarded"]
+        np.add.at(gained, world[paid], e["reward"][paid])
+        leaked = np.bincount(world[leak], minlength=n)
+
+        walk = np.flatnonzero(mv & ~dead & ~leak)
+        if len(walk):
+            x = e["x"][walk]
+            y = e["y"][walk]
+            i = index[walk]
+            target = self.path_xy[self.path_start[e["path"][walk]] + i + 1]
+            tx = target[:, 0]
+            ty = target[:, 1]
+            dx = tx - x
+            dy = ty - y
+            dist = np.float_power(dx*dx + dy*dy, 0.5)  # matches ** 0.5, np.sqrt doesn't always
+            step = e["step"][walk]
+            zero = dist == 0
+            snap = ~zero & (step >= dist)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                e["x"][walk] = np.where(snap, tx, np.where(zero, x, x + (dx/dist) * step))
+                e["y"][walk] = np.where(snap, ty, np.where(zero, y, y + (dy/dist) * step))
+            index[walk] = i + (zero | snap)
+
+        # the killed, the ones drones killed before and the leaked go, like compact()
+        gone = dead | leak
+        if gone.any():
+            self.enemies = select_rows(e, ~gone)
+        return gained.tolist(), leaked.tolist()
+
+    def fire(self, fighting):
+        # the tower loop of every world at once, returns what drone kills
+        # earned in each world
+        gained = [0] * len(self.worlds)
+        towers = [(k, t) for k, ts in fighting for t in ts]
+        if not towers:
+            return gained
+        e = self.enemies
+        # towers aim from their centre and want the earliest spawned enemy in
+        # range, drones look from where they are for the nearest alive one,
+        # the earliest spawned on a tie
+        info = np.array([v for k, t in towers for v in
+                         ((k, 1.0, t.drone.x, t.drone.y, 0) if t.kind == 2 else
+                          (k, 0.0, t.tx * TILE_SIZE + TILE_SIZE//2, t.ty * TILE_SIZE + TILE_SIZE//2, t.range * t.range))],
+                        np.float64).reshape(-1, 5)
+        drone = info[:, 1] > 0
+        ox = info[:, 2]
+        oy = info[:, 3]
+        r2 = info[:, 4]
+        owner, row, first, count = segment_pairs(e["world"], info[:, 0].astype(np.int64))
+        target = np.full(len(towers), -1)
+        some = count > 0
+        if some.any():
+            dx = (e["x"][row] + TILE_SIZE/2) - ox[owner]
+            dy = (e["y"][row] + TILE_SIZE/2) - oy[owner]
+            d = dx*dx + dy*dy
+            near = np.where(drone[owner] & e["alive"][row], d, np.inf)
+            nearest = np.full(len(towers), np.inf)
+            nearest[some] = np.minimum.reduceat(near, first[some])
+            ok = np.where(drone[owner], (near == nearest[owner]) & (near < np.inf), d <= r2[owner])
+            pos = np.where(ok, np.arange(len(row)), len(row))
+            best = np.full(len(towers), len(row))
+            best[some] = np.minimum.reduceat(pos, first[some])
+            hit = best < len(row)
+            target[hit] = row[best[hit]]
+
+        shots = []
+        x, y, hp, alive, rewarded = e["x"], e["y"], e["hp"], e["alive"], e["rewarded"]
+        # towers with nothing in range have nothing to do
+        busy = np.flatnonzero(drone | (count == 0) | (target >= 0))
+        for i, j, c in zip(busy.tolist(), target[busy].tolist(), count[busy].tolist()):
+            k, t = towers[i]
+            if t.kind == 2:
+                d = t.drone
+                if j >= 0 and not alive[j]:
+                    # a drone before it in this tick killed what it picked
+                    j = self.nearest(k, d)
+                if j < 0:
+                    d.idle()
+                elif d.chase(float(x[j]) + TILE_SIZE/2, float(y[j]) + TILE_SIZE/2):
+                    hp[j] -= t.drone_damage
+                    if hp[j] <= 0 and not rewarded[j]:
+                        alive[j] = False
+                        rewarded[j] = True
+                        gained[k] += int(e["reward"][j])
+                continue
+            if not c:
+                # nothing to shoot at, sleep until the next spawn
+                t.park()
+                continue
+            arena = self.worlds[k]["projectile_arena"]
+            cx = t.center_px()
+            cy = t.center_py()
+            if t.kind == 0:
+                arena.seq += 1
+                shots.append((k, arena.seq, cx, cy, int(e["seq"][j]), 0.0, 0.0, t.damage, 2.5, 0))
+            else:
+                px = float(x[j])
+                py = float(y[j])
+                for ox, oy in AOE_OFFSETS[:t.projectile_count]:
+                    arena.seq += 1
+                    shots.append((k, arena.seq, cx, cy, NO_TARGET, px + ox + TILE_SIZE/2, py + oy + TILE_SIZE/2,
+                                  t.damage, 2.5, t.splash))
+            t.sleep(t.reload)
+        self.add_rows([], shots)
+        return gained
+
+    def nearest(self, k, d):
+        # the row of the alive enemy of world k nearest drone d, or -1
+        e = self.enemies
+        a, b = np.searchsorted(e["world"], [k, k + 1]).tolist()
+        dx = (e["x"][a:b] + TILE_SIZE/2) - d.x
+        dy = (e["y"][a:b] + TILE_SIZE/2) - d.y
+        near = np.where(e["alive"][a:b], dx*dx + dy*dy, np.inf)
+        if not len(near) or near.min() == np.inf:
+            return -1
+        return a + int(np.argmin(near))
+
+    def move_shots(self, active):
+        # same branches as Projectile.update for the worlds whose tick got
+        # this far
+        s = self.shots
+        if not len(s["world"]):
+            return
+        e = self.enemies
+        act = active[s["world"]]
+        aimed = s["target"] != NO_TARGET
+        tx = s["tx"].copy()
+        ty = s["ty"].copy()
+        found = np.zeros(len(aimed), bool)
+        j = np.zeros(len(aimed), np.int64)
+        if len(e["world"]):
+            keys = e["world"] * 2**32 + e["seq"]
+            key = s["world"] * 2**32 + s["target"]
+            j = np.minimum(np.searchsorted(keys, key), len(keys) - 1)
+            found = aimed & (keys[j] == key) & e["alive"][j]
+            tx[found] = e["x"][j[found]] + TILE_SIZE/2
+            ty[found] = e["y"][j[found]] + TILE_SIZE/2
+        # a target that died took its shots with it
+        lost = act & aimed & ~found
+        dx = tx - s["x"]
+        dy = ty - s["y"]
+        dist = np.float_power(dx*dx + dy*dy, 0.5)
+        hit = act & ~lost & (dist < 3)
+
+        single = np.flatnonzero(hit & (s["radius"] == 0))
+        np.subtract.at(e["hp"], j[single], s["damage"][single])
+        splash = np.flatnonzero(hit & (s["radius"] > 0))
+        if len(splash):
+            # every enemy of the world in the radius, dead or not
+            owner, row, _, _ = segment_pairs(e["world"], s["world"][splash])
+            ex = e["x"][row] + TILE_SIZE/2
+            ey = e["y"][row] + TILE_SIZE/2
+            inside = (ex - tx[splash][owner])**2 + (ey - ty[splash][owner])**2 <= s["radius"][splash][owner]**2
+            np.subtract.at(e["hp"], row[inside], s["damage"][splash][owner][inside])
+
+        fly = np.flatnonzero(act & ~lost & ~hit & (dist != 0))
+        s["x"][fly] += (dx[fly]/dist[fly]) * s["speed"][fly]
+        s["y"][fly] += (dy[fly]/dist[fly]) * s["speed"][fly]
+        gone = lost | hit
+        if gone.any():
+            self.shots = select_rows(s, ~gone)
+
+BATCH_MIN_WORLDS = 10  # below this stepping the worlds one by one is faster
+
+def run_batch(map_index, frames, scripts):
+    # one world per script, all stepped together frame by frame like
+    # run_session, on a BatchEngine when numpy is there
+    worlds = [World(map_index) for _ in scripts]
+    engine = BatchEngine(worlds) if np is not None and len(worlds) >= BATCH_MIN_WORLDS else None
+    for frame in range(frames):
+        keys = [script.get(frame, set()) for script in scripts]
+        if engine is not None:
+            if not engine.step(keys):
+                break
+            continue
+        running = [(w, k) for w, k in zip(worlds, keys) if w.running()]
+        if not running:
+            break
+        for w, k in running:
+            w.step(k)
+    return worlds
+
+# wave estimator
+# predicts waves from the towers of the current game, or of a world, without
+# running its ticks. the enemies of one type spawned in one round at one
+# portal walk stacked on the same spot, so they are followed as one cohort on
+# the exact walk times of their path. every ESTIMATE_STEP ticks each tower
+# spends the damage it deals in that time on the first spawned cohort inside
+# its coverage intervals, drones take the cohort nearest their tower and the
+# shots of an AOE tower land around the first cohort in its coverage, each
+# one hitting every cohort within the splash of its point. projectile flight
+# and the walk from an off path portal are left out
+ESTIMATE_STEP = 10
+
+class Cohort:
+    def __init__(self, path, speed_tiles, spawn, count, hp, reward, seq):
+        self.path = path
+        self.step = speed_tiles * TILE_SIZE / 60.0
+        self.walk = walk_ticks(path, self.step)
+        self.spawn = spawn
+        self.count = count
+        self.hp = hp     # of every enemy behind the front one
+        self.front = hp
+        self.reward = reward
+        self.seq = seq
+
+    def position(self, tick):
+        # arc length and px of the enemy centers, None once they leaked
+        age = tick - self.spawn + 1
+        if age > self.walk[-1]:
+            return None
+        i = bisect.bisect_right(self.walk, age) - 1
+        arcs = path_arcs(self.path)
+        if i >= len(self.path) - 1:
+            (x, y), s = self.path[-1], arcs[-1]
+            return s, x * TILE_SIZE + TILE_SIZE / 2, y * TILE_SIZE + TILE_SIZE / 2
+        seg = arcs[i + 1] - arcs[i]
+        d = min(seg, (age - self.walk[i]) * self.step)
+        t = d / seg if seg else 0.0
+        (x0, y0), (x1, y1) = self.path[i], self.path[i + 1]
+        return (arcs[i] + d, (x0 + (x1 - x0) * t) * TILE_SIZE + TILE_SIZE / 2,
+                (y0 + (y1 - y0) * t) * TILE_SIZE + TILE_SIZE / 2)
+
+    def focus(self, damage):
+        # one enemy at a time, returns the kills and the damage left over
+        kills = 0
+        while self.count:
+            if damage < self.front:
+                self.front -= damage
+                return kills, 0
+            damage -= self.front
+            self.count -= 1
+            self.front = self.hp
+            kills += 1
+        return kills, damage
+
+    def splash(self, damage):
+        self.hp -= damage
+        self.front -= damage
+        if self.hp <= 0:
+            kills, self.count = self.count, 0
+            return kills
+        if self.front <= 0:
+            self.count -= 1
+            self.front = self.hp
+            return 1
+        return 0
+
+walk_cache = {}
+
+def walk_ticks(path, step):
+    # updates after spawning at which an enemy stands on each point of path,
+    # a move that would pass a point stops on it
+    key = (id(path), step)
+    entry = walk_cache.get(key)
+    if entry is None or entry[0] is not path:
+        ticks = [0]
+        for (x0, y0), (x1, y1) in zip(path, path[1:]):
+            dx = (x1 - x0) * TILE_SIZE; dy = (y1 - y0) * TILE_SIZE
+            seg = (dx*dx + dy*dy) ** 0.5
+            ticks.append(ticks[-1] + max(1, int(-(-seg // step))))
+        entry = walk_cache[key] = (path, ticks)
+    return entry[1]
+
+def wave_cohorts(w):
+    # the same enemies spawn_round and the boss spawn make for wave w
+    paths, spawns, map_x_offset, map_y_offset = get_paths(map_selection)
+    count = 2 + (w - 1)
+    fast = min(count, 2 + (w - 2)) if w >= 2 else 0
+    cohorts = []
+    for r in range(1, SPAWN_ROUNDS_PER_WAVE + 1):
+        for sx, sy in spawns:
+            local_paths = [p for p in paths if p and (p[0][0] + map_x_offset, p[0][1] + map_y_offset) == (sx, sy)]
+            path = local_paths[0] if local_paths else (paths[0] if paths else [])
+            if not path:
+                continue
+            tick = r * SPAWN_INTERVAL_FRAMES
+            if fast:
+                cohorts.append(Cohort(path, 2.0, tick, fast, 6 + w * 2, 6 + w, len(cohorts)))
+            if count > fast:
+                cohorts.append(Cohort(path, DEFAULT_SPEED_TILES, tick, count - fast, 4 + w * 2, 5 + w, len(cohorts)))
+    bosses = []
+    if w % 10 == 0 and paths:
+        for i in range(max(1, w // 10)):
+            bosses.append(Cohort(paths[i % len(paths)], 0.6, 0, 1, 400 + (w * 70) + ((w // 10) * 200), 150 + (w * 15), i))
+    return cohorts, bosses
+
+def estimate_wave(w, shooters):
+    # returns leaks, kills, money and the ticks the wave lasts
+    cohorts, bosses = wave_cohorts(w)
+    leaks = kills = money_made = 0
+    tick = 0
+    live = []
+    while cohorts or bosses or live:
+        tick += ESTIMATE_STEP
+        while cohorts and cohorts[0].spawn <= tick:
+            live.append(cohorts.pop(0))
+        if bosses and not cohorts and not live:
+            for b in bosses:
+                b.spawn = tick
+            live, bosses = bosses, []
+        where = {}
+        for c in live:
+            at = c.position(tick)
+            if at is None:
+                leaks += c.count
+                c.count = 0
+            else:
+                where[c] = at
+        live = [c for c in live if c.count]
+        for kind, rate, covered, cx, cy, area in shooters:
+            damage = rate * ESTIMATE_STEP
+            if kind == DroneTower.kind:
+                targets = sorted(live, key=lambda c: ((where[c][1] - cx) ** 2 + (where[c][2] - cy) ** 2, c.seq))
+            else:
+                targets = [c for c in live if any(s0 <= where[c][0] <= s1 for s0, s1 in covered.get(id(c.path), ()))]
+            if area is not None:
+                if not targets:
+                    continue
+                offsets, radius = area
+                _, x, y = where[targets[0]]
+                for ox, oy in offsets:
+                    for c in live:
+                        _, ex, ey = where[c]
+                        if c.count and (ex - x - ox) ** 2 + (ey - y - oy) ** 2 <= radius ** 2:
+                            k = c.splash(damage)
+                            kills += k
+                            money_made += k * c.reward
+                continue
+            for c in targets:
+                k, damage = c.focus(damage)
+                kills += k
+                money_made += k * c.reward
+                if not damage:
+                    break
+        live = [c for c in live if c.count]
+    return leaks, kills, money_made + 10, tick
+
+def estimate_waves(count, world=None):
+    # one (wave, leaks, kills, money, ticks) per wave from the current one on,
+    # stops early once the base would fall
+    if world is not None:
+        with world:
+            return estimate_waves(count)
+    shooters = []
+    for t in towers:
+        if t.map_index != map_selection:
+            continue
+        cx = t.center_px(); cy = t.center_py()
+        if t.kind == DroneTower.kind:
+            shooters.append((t.kind, t.drone_damage / t.drone.reload if t.drone else 0, None, cx, cy, None))
+            continue
+        covered = {id(p): path_coverage(p, cx, cy, t.range) for p in get_paths(t.map_index)[0]}
+        # AOE towers deal their damage per shot, at the same offsets as update
+        area = (AOE_OFFSETS[:t.projectile_count], t.splash) if t.kind == AOETower.kind else None
+        shooters.append((t.kind, t.damage / t.reload, covered, cx, cy, area))
+    rows = []
+    hp = base_hp
+    for w in range(wave, wave + count):
+        leaks, kills, made, ticks = estimate_wave(w, shooters)
+        rows.append((w, leaks, kills, made, ticks))
+        hp -= leaks
+        if hp <= 0:
+            break
+    return rows
+
+# out-of-process simulation
+# the sim process runs update() for the game, pause and boss screens and
+# publishes every tick into one of two buffers in shared memory. the window
+# process only reads the latest complete buffer and sends its keys back.
+SIM_FPS = 30
+SIM_MAX_RECORDS = 8192
+SIM_KEYS = [pyxel.KEY_UP, pyxel.KEY_DOWN, pyxel.KEY_LEFT, pyxel.KEY_RIGHT,
+            pyxel.KEY_RETURN, pyxel.KEY_SPACE, pyxel.KEY_BACKSPACE, pyxel.KEY_P,
+            pyxel.KEY_I, pyxel.KEY_U, pyxel.KEY_1, pyxel.KEY_2, pyxel.KEY_3]
+SIM_HUD_FIELDS = ["game_state", "pause_selection", "base_hp", "money", "wave",
+                  "infinite_mode", "wave_active", "selected_tower_type", "show_info",
+                  "cursor_x", "cursor_y", "cam_x", "cam_y"]
+
+# header: front buffer index, then a sequence number per buffer
+# (odd while the buffer is being written)
+SIM_CONTROL = struct.Struct("<3I")
+SIM_SEQ = struct.Struct("<I")
+SIM_HUD = struct.Struct("<%di" % (len(SIM_HUD_FIELDS) + 2))  # + tick, record count
+SIM_RECORD = struct.Struct("<5h")  # kind, x, y, a, b
+SIM_BUFFER_SIZE = SIM_HUD.size + SIM_MAX_RECORDS * SIM_RECORD.size
+SIM_SHM_SIZE = 16 + 2 * SIM_BUFFER_SIZE
+
+REC_SPRITE = 0  # x, y top left, a, b image bank u, v
+REC_TOWER = 1   # x, y tile, a tower class, b level
+REC_SHOT = 2    # x, y center
+
+sim_tick = 0
+
+def sim_records():
+    # same order as draw_game draws them
+    records = []
+    for e in enemies:
+        records.append((REC_SPRITE, int(e.px), int(e.py), e.sprite[0] * 8, e.sprite[1] * 8))
+    for t in towers:
+        if t.map_index != map_selection:
+            continue
+        records.append((REC_TOWER, t.tx, t.ty, TOWER_CLASSES.index(type(t)), t.level))
+        if isinstance(t, DroneTower) and t.drone:
+            sx, sy = DRONE_SPRITES[max(1, min(3, t.level)) - 1]
+            records.append((REC_SPRITE, int(t.drone.x) - 4, int(t.drone.y) - 4, sx * 8, sy * 8))
+    for p in projectiles:
+        records.append((REC_SHOT, int(p.x), int(p.y), 0, 0))
+    return records[:SIM_MAX_RECORDS]
+
+def publish_frame(buf):
+    front = SIM_CONTROL.unpack_from(buf, 0)[0]
+    back = 1 - front
+    seq_off = 4 + back * 4
+    seq = SIM_SEQ.unpack_from(buf, seq_off)[0]
+    SIM_SEQ.pack_into(buf, seq_off, seq + 1)
+
+    records = sim_records()
+    base = 16 + back * SIM_BUFFER_SIZE
+    g = globals()
+    SIM_HUD.pack_into(buf, base, *[int(g[name]) for name in SIM_HUD_FIELDS], sim_tick, len(records))
+    data = b"".join([SIM_RECORD.pack(*r) for r in records])
+    buf[base + SIM_HUD.size:base + SIM_HUD.size + len(data)] = data
+
+    SIM_SEQ.pack_into(buf, seq_off, seq + 2)
+    SIM_CONTROL.pack_into(buf, 0, back, *SIM_CONTROL.unpack_from(buf, 0)[1:])
+
+def read_frame(buf):
+    front = SIM_CONTROL.unpack_from(buf, 0)[0]
+    seq_off = 4 + front * 4
+    seq = SIM_SEQ.unpack_from(buf, seq_off)[0]
+    if seq == 0 or seq & 1:
+        return None
+    base = 16 + front * SIM_BUFFER_SIZE
+    hud = SIM_HUD.unpack_from(buf, base)
+    data = bytes(buf[base + SIM_HUD.size:base + SIM_HUD.size + hud[-1] * SIM_RECORD.size])
+    if SIM_SEQ.unpack_from(buf, seq_off)[0] != seq:
+        # overwritten while we were copying, keep the previous frame
+        return None
+    return hud, list(SIM_RECORD.iter_unpack(data))
+
+def sim_worker(shm_name, conn, map_index, tiles, cursor, sizes, telemetry, trace, alloc):
+    global tile_snapshot, injected_keys, map_selection, game_state
+    global cursor_x, cursor_y, enemy_paths, sim_tick, telemetry_on
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # spawn re-imports the module, so whatever the command line changed has to
+    # be handed over, the map sizes before any map is entered
+    MAP_SIZES[:] = sizes
+    telemetry_on = telemetry
+    if trace is not None:
+        open_trace(*trace, append=True)
+    if alloc:
+        start_alloc_track()
+    tile_snapshot = tiles
+    map_selection = map_index
+    cursor_x, cursor_y = cursor
+    enter_map(map_index)
+    enemy_paths = get_paths(map_index)[0]
+    game_state = STATE_GAME
+    start_wave()
+
+    # one list of keys per window frame, in order, replayed one per tick so
+    # presses that arrive while the sim is behind are all played
+    batches = []
+    next_tick = time.perf_counter()
+    try:
+        while game_state != STATE_MENU:
+            while conn.poll():
+                msg = conn.recv()
+                if msg is None:
+                    return
+                batches.append(msg)
+            injected_keys = set(batches.pop(0)) if batches else set()
+            update()
+            sim_tick += 1
+            publish_frame(shm.buf)
+
+            next_tick += 1.0 / SIM_FPS
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # running behind, don't try to catch up
+                next_tick = time.perf_counter()
+    finally:
+        shm.close()
+
+class SimLink:
+    def __init__(self, map_index):
+        ctx = multiprocessing.get_context("spawn")
+        self.shm = shared_memory.SharedMemory(create=True, size=SIM_SHM_SIZE)
+        self.shm.buf[:16] = bytes(16)
+        self.conn, child_conn = ctx.Pipe()
+        self.proc = ctx.Process(target=sim_worker, daemon=True,
+                                args=(self.shm.name, child_conn, map_index,
+                                      snapshot_map(map_index), (cursor_x, cursor_y),
+                                      list(MAP_SIZES), telemetry_on,
+                                      None if trace_file is None else (trace_file.name, trace_every),
+                                      alloc_on))
+        self.proc.start()
+        self.tick = -1
+        self.records = []
+        self.tower_records = []
+
+    def update(self):
+        global game_state
+        keys = [k for k in SIM_KEYS if pyxel.btnp(k)]
+        if keys:
+            try:
+                self.conn.send(keys)
+            except (BrokenPipeError, OSError):
+                pass
+        self.read()
+        if not self.proc.is_alive():
+            # the sim stopped, either at the menu or because it died, so
+            # whatever it published last is final
+            game_state = STATE_MENU
+
+    def read(self):
+        frame = read_frame(self.shm.buf)
+        if frame is None or frame[0][-2] == self.tick:
+            return
+        hud, self.records = frame
+        self.tick = hud[-2]
+        g = globals()
+        for name, value in zip(SIM_HUD_FIELDS, hud):
+            g[name] = value
+        tower_records = [r for r in self.records if r[0] == REC_TOWER]
+        if tower_records != self.tower_records:
+            self.tower_records = tower_records
+            mirror_towers(tower_records)
+
+    def draw_entities(self):
+        if compositor is not None:
+            compositor.draw(self.entity_chunks())
+            return
+        for kind, x, y, a, b in self.records:
+            if kind == REC_SPRITE:
+                if in_view(x, y): pyxel.blt(x, y, 0, a, b, 8, 8, 0)
+            elif kind == REC_TOWER:
+                if in_view(x * TILE_SIZE, y * TILE_SIZE): tower_at(x, y).draw()
+            elif in_view(x - 4, y - 4):
+                pyxel.circ(x, y, 1, 7)
+
+    def entity_chunks(self):
+        chunks = []
+        stamps = []
+        ring = ring_tower()
+        for kind, x, y, a, b in self.records:
+            if kind == REC_SPRITE:
+                stamps.append((x, y, compositor.key(a, b)))
+            elif kind == REC_TOWER:
+                t = tower_at(x, y)
+                stamps.append(tower_stamp(t))
+                if t is ring:
+                    chunks += [stamp_columns(stamps), None]
+                    stamps = []
+            else:
+                stamps.append((x - 1, y - 1, SHOT))
+        chunks.append(stamp_columns(stamps))
+        return chunks
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.proc.join(1)
+        if self.proc.is_alive():
+            self.proc.terminate()
+        self.shm.close()
+        self.shm.unlink()
+
+def mirror_towers(tower_records):
+    # window side copies of the sim towers, only used for drawing and the HUD,
+    # drones come through as sprite records
+    clear_towers()
+    for _, tx, ty, cls, level in tower_records:
+        t = TOWER_CLASSES[cls](tx, ty, map_selection)
+        while t.level < level:
+            t.level += 1
+            t.on_upgrade()
+        if isinstance(t, DroneTower):
+            t.drone = None
+        add_tower(t)
+
+def close_sim_link():
+    global sim_link
+    if sim_link is not None:
+        sim_link.close()
+        sim_link = None
+
+def update_sim_link():
+    sim_link.update()
+    if game_state == STATE_MENU:
+        close_sim_link()
+        safe_return_to_menu()
+
 # loop
 def update():
+    global sim_link
+    if alloc_on:
+        alloc_phase(ALLOC_OTHER)
+    # ui timers belong to the window, they run once a frame and not per world
+    ui_timers.advance()
+    if sim_link is not None:
+        update_sim_link()
+        return
+    update_state()
+
+    if sim_process and game_state == STATE_GAME:
+        sim_link = SimLink(map_selection)
+
+def update_state():
     if game_state == STATE_MENU:
         update_menu()
     elif game_state == STATE_MAP_SELECT:
         update_map_select()
     elif game_state == STATE_GAME:
         update_game()
+        if trace_file is not None:
+            trace_tick()
     elif game_state == STATE_PAUSE:
         update_pause()
     elif game_state == STATE_BOSS_CHOICE:
@@ -982,6 +3185,65 @@ def init_game_start():
     enemy_paths = find_paths(map_selection)
     start_wave()
 
-enemy_paths = find_paths(map_selection)
-start_wave()
-pyxel.run(update, draw)
+if __name__ == "__main__":
+    if "--compare-traces" in sys.argv:
+        i = sys.argv.index("--compare-traces")
+        result = compare_traces(sys.argv[i + 1], sys.argv[i + 2])
+        if result is None:
+            print("traces match")
+        else:
+            print("first divergence at tick %d: %s" % (result[0], ", ".join(result[1])))
+        sys.exit(0 if result is None else 1)
+
+    sim_process = "--sim-process" in sys.argv
+    telemetry_on = "--telemetry" in sys.argv
+    if "--alloc-track" in sys.argv:
+        start_alloc_track()
+    atexit.register(close_sim_link)
+    if arg_value("--trace"):
+        open_trace(arg_value("--trace"), int(arg_value("--trace-every", "1")))
+    # the game never plays sounds, headless runs don't draw either, and with a
+    # valid asset cache the tilemap doesn't need decoding
+    headless = arg_value("--session") is not None
+    if arg_value("--custom-size"):
+        resize_custom_map(*map(int, arg_value("--custom-size").lower().split("x")))
+    key = asset_key()
+    cache = open_asset_cache(key)
+    if headless and cache is not None:
+        use_asset_cache(cache, tilemap=False)
+    else:
+        pyxel.init(WIDTH, HEIGHT, title="MachinesTD")
+        pyxel.load(RESOURCE_FILE, exclude_images=headless, exclude_tilemaps=cache is not None,
+                   exclude_sounds=True, exclude_musics=True)
+        if cache is not None:
+            use_asset_cache(cache)
+        else:
+            # cached with the fill, so a headless launch gets the same grass
+            if MAP_SIZES[2] != (MAP_TILES_W, MAP_TILES_H):
+                fill_custom_map()
+            write_asset_cache(key)
+        if "--compositor" in sys.argv and np is not None:
+            compositor = Compositor()
+    if cache is not None:
+        cache.close()
+    enemy_paths = get_paths(map_selection)[0]
+    start_wave()
+    if arg_value("--session") and arg_value("--batch"):
+        # balance runs, the same session played by --batch worlds at once
+        script = load_script(arg_value("--session"))
+        start = time.perf_counter()
+        worlds = run_batch(int(arg_value("--map", "0")), int(arg_value("--frames", "18000")),
+                           [script] * int(arg_value("--batch")))
+        for i, w in enumerate(worlds):
+            print("world %d: wave %d money %d hp %d" % (i, w["wave"], w["money"], w["base_hp"]))
+        print("%d worlds in %.2fs" % (len(worlds), time.perf_counter() - start))
+        sys.exit(0)
+    if arg_value("--session"):
+        run_session(int(arg_value("--map", "0")), int(arg_value("--frames", "18000")),
+                    load_script(arg_value("--session")))
+        if arg_value("--estimate"):
+            # how the layout the session ended with would hold up
+            for row in estimate_waves(int(arg_value("--estimate"))):
+                print("wave %d: leaks %d kills %d money %d ticks %d" % row)
+        sys.exit(0)
+    pyxel.run(update, draw)